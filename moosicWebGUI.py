@@ -36,11 +36,12 @@ moosicWebGUI - web GUI for controlling the moosicd daemon
 SYNOPSIS
 --------
 'moosicWebGUI.py' [-p number] [-s] [-i] [-j name] [-a host]
-[-n net] [-h] [-m] [-d] [-c configdir] [-t template]
+[-n net] [-h] [-m] [-d] [-c configdir] [-t template] [-w number]
 [--port=number] [--server-only] [--ignore-exit]
 [--jukebox-dir=name] [--add-host=host] [--add-network=net]
 [--help] [--manual] [--debug] [--config=configdir]
-[--template=template]
+[--template=template] [--workers=number] [--status-ttl=seconds]
+[--chunk-size=number] [--watch=seconds]
 
 
 DESCRIPTION
@@ -87,6 +88,21 @@ OPTIONS
 '-t template, --template=template'::
         use specified template file
 
+'-w number, --workers=number'::
+        serve requests with number worker threads (default: 4)
+
+'--status-ttl=seconds'::
+        show moosicd status at most seconds old (default: 1)
+
+'--chunk-size=number'::
+        add directories to the playlist sending at most number
+        files per call to moosicd (default: 500)
+
+'--watch=seconds'::
+        keep the index of the jukebox directory current: watch it
+        for changes (module pyinotify) or, if not available, look
+        for changed directories every seconds
+
 Options specified at the command line are evaluated from left
 to right.
 
@@ -133,6 +149,54 @@ specified.
 
 An alternate template may be specified by means of option '-t'.
 
+With option '--watch' the index of the jukebox directory is kept
+current in the background, there is no need to rescan. Changes are
+picked up through inotify if module pyinotify is installed, else
+the directories are checked for changes periodically.
+
+The index is saved in the moosic configuration directory and used
+again at the next start unless the jukebox directory or moosic's
+configuration changed. The jukebox directory and its subdirectories
+are checked for changes made meanwhile; subtrees changed are read
+again in the background.
+
+Requests are served concurrently by a pool of worker threads, so
+a slow request (e.g. a search in a large jukebox) does not block
+other browsers. The number of worker threads may be set by means
+of option '-w'. As many threads read the jukebox directory in
+parallel when it is scanned (using module scandir, if available, to
+save a stat call per file). The scan runs in the background, the
+old index is used until the new one is complete and pages show the
+scan's progress meanwhile.
+
+The status of moosicd (current track, play time, ...) is polled by
+a background thread once per second, pages show this snapshot. The
+interval may be changed by means of option '--status-ttl'; commands
+changing moosicd's state always fetch a fresh status.
+
+Every command is also available as '/api/<command>' answering
+with a JSON object (status of moosicd, message and the data of the
+view selected by parameter 'view') instead of an HTML page. Lists
+are paged by parameters 'start' and 'size' (default: 0 and 250),
+'total' is null if the length of a list is not known (history).
+Matches of a search are looked for only as far as needed for the
+page, their number is given as 'total' if known (parameter 'total=1'
+counts them all) or else as 'at_most' if an upper bound is known.
+View 'standard' returns the status only, e.g. '/api/refresh' is a
+cheap way to poll the current track. Commands showing a page of
+their own answer with its data instead: 'load' with the stored
+playlists ('playlists'), 'list_pl' and 'list_memo' with the entries
+of the playlist file ('playlist_file'), 'diagnostics' with the
+statistics ('diagnostics'). The message is plain text.
+
+Clients wanting to follow moosicd's status may instead connect to
+'/events', a stream of server-sent events: after the full status
+each event carries only the changed fields (and a generation number
+of the playlist, changing whenever the playlist may have changed).
+All streams are fed by the one
+background thread polling moosicd and do not occupy a worker
+thread.
+
 
 FILES
 -----
@@ -182,8 +246,8 @@ Can not start new server, giving up. Sorry.::
 
 AVAILABILITY
 ------------
-'moosicWebGUI' is available on all platforms supporting Python 2.2
-or later.
+'moosicWebGUI' is available on all platforms supporting Python 2.6
+or 2.7 (it does not run with Python 3).
 
 
 CAVEATS
@@ -238,9 +302,21 @@ moosic(1), moosicd(1), validate(1)
 
 import getopt, os, os.path, socket, string, sys, time
 import urllib, errno, random, re, fileinput, base64, marshal
+import threading, Queue, cgi, bisect, array, mmap, struct, itertools, json
 import BaseHTTPServer, SimpleHTTPServer, webbrowser
 import moosic.client.factory
 from xmlrpclib import Binary
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
 
 # Request Handler for HTTP requests to our server
 
@@ -275,7 +351,14 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 
         self.message     = ""
         self.dyn_content = ''
+        self.data        = {}       # data of dyn_content, for api answers
+        self.state       = moosicdState()
+        self.expect      = None     # state moosicd shall reach after command
+        self.waited      = 0.0      # time spent waiting for moosicd
+        self.legacy      = 0.1      # time we used to sleep instead
         form             = {}
+        files            = []       # all "file" parameters (batch commands)
+        proxy.reset_rpc_count()
 
         # favicon.ico requested ?
         if self.path == "/favicon.ico":
@@ -288,6 +371,17 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
                 pass
             return
 
+        # stream of status changes requested ?
+        if self.path == "/events":
+            self.send_response(200, 'OK')
+            self.wfile.write('Content-type: text/event-stream\n')
+            self.wfile.write('Cache-Control: no-cache\n\n')
+            self.wfile.flush()
+            # the connection is served by the event thread from now on
+            self.server.detach(self.connection)
+            events.add(self.connection)
+            return
+
         # favicon.ico requested ?
         if self.path.endswith(".html"):
             print mydir
@@ -317,9 +411,16 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
                 chunks = string.split(par,"=")
                 if len(chunks)>1:
                     form[urllib.unquote_plus(chunks[0])] = urllib.unquote_plus(chunks[1])
+                    if urllib.unquote_plus(chunks[0]) == "file":
+                        files.append(urllib.unquote_plus(chunks[1]))
                 else:
                     form[urllib.unquote_plus(chunks[0])] = None
 
+        # machine readable answer requested?
+        self.api = command.startswith("api/")
+        if self.api:
+            command = command[4:]
+
         # check existance and/or validity parameters supplied with request:
         if not command:
             command = "index"
@@ -343,6 +444,18 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         self.file = form.get("file", "")
         if string.find(self.file, myroot) != 0 or string.find(self.file,"/..") >= 0:
             self.file = myroot
+        # filename arguments of batch commands (invalid ones are dropped)
+        self.files = [f for f in files
+                      if string.find(f, myroot) == 0 and string.find(f,"/..") < 0]
+        # action of batch commands
+        self.action = form.get("action", "")
+        # saved search result
+        self.result = None
+        if form.has_key("result"):
+            try:
+                self.result = int(form["result"])
+            except ValueError:
+                pass
         # number argument (for skip etc.)
         self.count = 0
         if form.has_key("count"):
@@ -357,54 +470,84 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
                 self.pos = int(form["pos"])
             except ValueError:
                 pass
-
-        # get current moosicd status
-        self.is_queue_running = proxy.is_queue_running()
-        self.is_looping       = proxy.is_looping()
-        self.is_paused        = proxy.is_paused()
-        self.queue_length     = proxy.queue_length()
-
-        #####################
-        # command dispatcher.
-        #####################
-        if hasattr(self, "_do__" + command):
-            # execute functions which return special pages -- processing ends here
-            if debug:
-                print "executing _do__" + command
-            meth = getattr(self, "_do__" + command)
-            meth()
-            return
-        elif hasattr(self, "_do_" + command):
-            # execute functions which return standard pages
-            if debug:
-                print "executing _do_" + command
-            meth = getattr(self, "_do_" + command)
-            meth()
-        else:
-            self.message += '<font color="#aa0000">Command "%s" is not (yet) implemented. </font>' % command
+        # paging of api answers and search results
+        self.start = 0
+        self.size  = limit
+        try:
+            self.start = max(int(form.get("start", 0)), 0)
+            self.size  = max(int(form.get("size", limit)), 0)
+        except ValueError:
+            pass
+        # count all search results
+        self.total = form.get("total", "0") != "0"
+
+        # commands modifying moosicd's state are executed one at a time,
+        # the status they read must still be valid when they act upon it
+        locked = command in mutating_commands
+        if locked:
+            command_lock.acquire()
+        try:
+            #####################
+            # command dispatcher.
+            #####################
+            if self.api and (command[:1] == "_" or hasattr(self, "_do__" + command)):
+                self.message += 'Command "%s" is not available through the api. ' % command
+            elif hasattr(self, "_do__" + command):
+                # execute functions which return special pages -- processing ends here
+                if debug:
+                    print "executing _do__" + command
+                meth = getattr(self, "_do__" + command)
+                meth()
+                return
+            elif hasattr(self, "_do_" + command):
+                # execute functions which return standard pages
+                if debug:
+                    print "executing _do_" + command
+                meth = getattr(self, "_do_" + command)
+                meth()
+                if self.expect:
+                    # moosicd carries out some commands with some latency
+                    self.confirm(self.expect)
+                latency.add(command, self.waited, self.legacy)
+                traffic.add(command, proxy.rpc_count(), proxy.bytes_sent())
+            else:
+                self.message += '<font color="#aa0000">Command "%s" is not (yet) implemented. </font>' % command
+        finally:
+            if locked:
+                # what we know about moosicd's state is outdated now
+                self.state.invalidate()
+                command_lock.release()
 
         # if the function called by the dispatcher did not produce a message
         # we just say which function was executed
         if not self.message:
             self.message += "Command '%s' executed. " % command
+        if self.api:
+            self.api_answer(command)
+            return
 
-        # moosicd has some latency time for some commands, so we just wait a bit
-        time.sleep(0.05)
+        if rescanner.running():
+            # until the new index goes live
+            self.message += "<br>Scanning: %s" % rescanner.progress.text()
 
         # if the function called by the dispatcher did not produce its own content
         # we create content for the selected view type
         if not self.dyn_content:
             meth = getattr(self, "cont_" + self.view)
-            self.dyn_content = meth()
-
-        # get current moosicd status (again)
-        is_queue_running = proxy.is_queue_running()
-        is_looping       = proxy.is_looping()
-        is_paused        = proxy.is_paused()
-        queue_length     = proxy.queue_length()
-        time.sleep(0.05)
-        current_track    = proxy.current().data
-        current_time     = proxy.current_time()
+            # keep a concurrent rescan from swapping the index under our feet
+            index_lock.acquire_read()
+            try:
+                self.dyn_content = meth()
+            finally:
+                index_lock.release_read()
+
+        # get current moosicd status (unless the view did already)
+        is_queue_running = self.state.is_queue_running()
+        is_looping       = self.state.is_looping()
+        is_paused        = self.state.is_paused()
+        queue_length     = self.state.queue_length()
+        current_track    = self.state.current()
+        current_time     = self.state.current_time()
 
         # write headers
         self.send_response(200, 'Script output follows')
@@ -413,7 +556,10 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         # build result page from template
         content = template
         if debug:
-            content = string.replace(content, "@@debug", "<hr><pre>\n%s\n%s</pre><hr>" % (self.path,form))
+            rpcs = "%d moosicd RPCs (%d bytes sent) for this request, status snapshot version %d" % \
+                   (proxy.rpc_count(), proxy.bytes_sent(), self.state.version())
+            print rpcs
+            content = string.replace(content, "@@debug", "<hr><pre>\n%s\n%s\n%s</pre><hr>" % (self.path,form,rpcs))
         else:
             content = string.replace(content, "@@debug", "")
 
@@ -479,7 +625,7 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 
     def _do__list2(self):
         """write current state of playlist to text file/plain page in .m3u format"""
-        playlist = [i.data for i in proxy.list()]
+        playlist = queue.get()
         self.send_response(200, 'Script output follows')
         self.wfile.write('Content-type: text/plain\n\n')
         self.wfile.write('#EXTM3U\n')
@@ -498,14 +644,7 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
             #files = os.popen('find "%s" -type f -print' % dir).readlines()
             files = getfiles(dir)
             files.sort()
-            count = 0
-            proxy.halt_queue()
-            for file in files:
-                if file_is_moosical(file) and string.find(file, "/.") < 0:
-                    proxy.append([Binary(file)])
-                    count += 1
-            if self.is_queue_running:
-                proxy.run_queue()
+            count = add_files(files, self.state.is_queue_running())
             self.message += "%d files added to bottom of playlist from directory '%s'. " % (count, dir[len(myroot)+1:])
         else:
             self.message += "Weird error -- no directory name given. "
@@ -516,31 +655,53 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
             dir = self.dir
             files = getfiles(dir)
             files.sort()
-            files.reverse()
-            count = 0
-            proxy.halt_queue()
-            for file in files:
-                if file_is_moosical(file) and string.find(file, "/.") < 0:
-                    proxy.prepend([Binary(file)])
-                    count += 1
-            if self.is_queue_running:
-                proxy.run_queue()
+            count = add_files(files, self.state.is_queue_running(), top=True)
             self.message += "%d files added to top of playlist from directory '%s'. " % (count, dir[len(myroot)+1:])
         else:
             self.message += "Weird error -- no directory name given. "
 
     def _do_advance(self):
         """toggle advance mode"""
-        if self.is_queue_running:
+        if self.state.is_queue_running():
             proxy.halt_queue()
         else:
             proxy.run_queue()
+            self.expect = player_settled
 
     def _do_append(self):
         """add single file to bottom of playlist"""
         proxy.append([Binary(self.file)])
+        queue.appended([self.file])
         self.message += "File '%s' appended to playlist. " % format_name(self.file)
 
+    def _do_batch(self):
+        """add selected files (or a saved search result) to playlist"""
+        files = self.files
+        if self.result is not None:
+            pattern = search_results.get(self.result)
+            if pattern is None:
+                self.message += "Search result has expired, please search again. "
+                return
+            files = findfiles(pattern)
+        if not files:
+            self.message += "No files selected. "
+            return
+        if self.action == "append":
+            count = add_files(files, self.state.is_queue_running())
+            self.message += "%d files appended to playlist. " % count
+        elif self.action == "prepend":
+            count = add_files(files, self.state.is_queue_running(), top=True)
+            self.message += "%d files prepended to playlist. " % count
+        elif self.action == "play":
+            before = self.state.snapshot()
+            self.expect = lambda status: player_settled(status, before)
+            proxy.stop()
+            count = add_files(files, False, top=True)
+            proxy.run_queue()
+            self.message += "Now playing %d selected files. " % count
+        else:
+            self.message += "Weird error -- unknown action '%s'. " % self.action
+
     def _do_chdir(self):
         """change current working directory"""
         try:
@@ -565,6 +726,7 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     def _do_clear2(self):
         """clear playlist"""
         proxy.clear()
+        queue.replaced([])
 
     def _do_clearmemo(self):
         """prepare confirmation page for clear memo command"""
@@ -587,31 +749,32 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 
     def _do_del_current(self):
         """stop current track, remove it from playlist and play next song, if any"""
-        current_track = proxy.current().data
-        if not current_track:
+        before = self.state.snapshot()
+        if not before["current"]:
             self.message += "There is currently no track playing that can be removed. "
         else:
+            paused = self.state.is_paused()
             proxy.stop()
-            playlist = [i.data for i in proxy.list()]
-            del playlist[0]
-            proxy.replace([Binary(i) for i in playlist])
+            playlist = queue.get(fresh=True)
+            change_queue(playlist, playlist[1:], False)
             proxy.run_queue()
-            # wait a bit for moosicd...
-            time.sleep(0.05)
-            if self.is_paused:
+            # the next track must be playing before it can be paused
+            self.legacy += 0.05
+            self.confirm(lambda status: player_settled(status, before))
+            if paused:
                 proxy.pause()
 
     def _do_deldup(self):
         """delete all duplicate entries in playlist"""
-        oldlist = [i.data for i in proxy.list()]
+        oldlist = queue.get(fresh=True)
         newlist = []
         temp    = {}
         for track in oldlist:
             if not temp.has_key(track):
                 temp[track]=None
                 newlist.append(track)
-        proxy.replace([Binary(i) for i in newlist])
-        self.message += "%d items deleted from playlist. " % (self.queue_length - proxy.queue_length())
+        change_queue(oldlist, newlist, self.state.is_queue_running())
+        self.message += "%d items deleted from playlist. " % (len(oldlist) - len(newlist))
 
     def _do_exit(self):
         """write good-bye message and exit program"""
@@ -636,6 +799,20 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         else:
             self.message += 'Exit requests are ignored, moosicWebGUI still running... '
 
+    def _do_diagnostics(self):
+        """display statistics collected since program start"""
+        self.dyn_content += latency.html()
+        self.dyn_content += traffic.html()
+        self.dyn_content += search_cache.html()
+        self.message += "Statistics since start-up of %s. " % progname
+        progress = rescanner.progress
+        last_scan = None
+        if progress is not None and progress.finished is not None:
+            self.message += "<br>Last scan: %s" % progress.text()
+            last_scan = progress.state()
+        self.data["diagnostics"] = {"latency": latency.state(), "traffic": traffic.state(),
+                                    "search_cache": search_cache.state(), "last_scan": last_scan}
+
     def _do_files(self):
         """switch to file view mode"""
         self.view = "files"
@@ -682,7 +859,7 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 
     def _do_load(self):
         """display stored playlists"""
-        global playlists
+        playlists = library.playlists
         content = ['<table class="menu" border="0" width="100%" cellspacing="0">\n']
         content.append('<tr><th colspan="6" align="left">Stored playlists</th></tr>\n')
         count = 0
@@ -701,6 +878,7 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         content.append("</table>\n")
         self.message += "Found %d stored playlists. " % len(playlists)
         self.dyn_content = ''.join(content)
+        self.data["playlists"] = self.api_page(playlists)
 
     def _do_load_pl(self):
         """load playlist from file"""
@@ -718,7 +896,8 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
                 if file_is_moosical(file) and string.find(file, "/.") < 0:
                     result.append(file)
                     count += 1
-            playlist = [i.data for i in proxy.list()]
+            oldlist = queue.get(fresh=True)
+            playlist = oldlist
             if self.lmode == "mixin":
                 playlist = mixin(playlist, result)
                 msg = "%d files mixed into playlist " % count
@@ -731,7 +910,7 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
             else:
                 playlist = playlist + result
                 msg = "%d files appended to playlist " % count
-            proxy.replace([Binary(i) for i in playlist])
+            change_queue(oldlist, playlist, self.state.is_queue_running())
             self.message += msg + "from stored playlist '%s'. " % self.file
         else:
             self.message += "Weird error -- no filename name given. "
@@ -750,7 +929,7 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 
     def _do_memo(self):
         """memorize current track"""
-        current_track = proxy.current().data
+        current_track = self.state.current()
         if not current_track:
             self.message += "There is currently no track playing that can be memorized. "
         else:
@@ -782,9 +961,8 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
                 if file_is_moosical(file) and string.find(file, "/.") < 0:
                     result.append(file)
                     count += 1
-            playlist = [i.data for i in proxy.list()]
-            playlist = mixin(playlist, result)
-            proxy.replace([Binary(i) for i in playlist])
+            oldlist = queue.get(fresh=True)
+            change_queue(oldlist, mixin(oldlist, result), self.state.is_queue_running())
             self.message += "%d files mixed into playlist from directory '%s'. " % (count,dir[len(myroot)+1:])
         else:
             self.message += "Weird error -- no directory name given. "
@@ -804,7 +982,7 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 
     def _do_pause(self):
         """toggle pause state"""
-        if self.is_paused:
+        if self.state.is_paused():
             proxy.unpause()
         else:
             proxy.pause()
@@ -813,21 +991,27 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         """play command"""
         proxy.run_queue()
         proxy.unpause()
+        self.expect = player_settled
 
     def _do_play_last(self):
         """add selected file to bottom of playlist"""
         proxy.prepend([Binary(self.file)])
+        queue.prepended([self.file])
         self.message += "Track '%s' appended to playlist. " % format_name(self.file)
 
     def _do_play_next(self):
         """add selected file to top of playlist"""
         proxy.prepend([Binary(self.file)])
+        queue.prepended([self.file])
         self.message += "Playing next track '%s'. " % format_name(self.file)
 
     def _do_play_now(self):
         """play immediately selected file"""
+        before = self.state.snapshot()
+        self.expect = lambda status: player_settled(status, before)
         proxy.stop()
         proxy.prepend([Binary(self.file)])
+        queue.prepended([self.file])
         proxy.run_queue()
         self.message += "Now playing track '%s'. " % format_name(self.file)
 
@@ -838,6 +1022,7 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     def _do_prepend(self):
         """add selected file to top of playlist"""
         proxy.prepend([Binary(self.file)])
+        queue.prepended([self.file])
         self.message += "Track '%s' prepended to playlist. " % format_name(self.file)
 
     def _do_refresh(self):
@@ -849,14 +1034,11 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         self.move_helper(0)
 
     def _do_rescan(self):
-        """rescan jukebox directory"""
-        global tree, playlists, parent, length
-        tree, playlists, parent = recurse(myroot, {}, [], {myroot : None})
-        tree, length, playlists = cleanup(tree, playlists)
-        dump_data()
-        self.message += '''Scan of jukebox directory '%s' completed. <br>
-                           Found %d music files in %d directories and %d playlists. ''' % \
-                           (myroot, length[myroot], len(tree), len(playlists))
+        """rescan jukebox directory in the background"""
+        if rescanner.start():
+            self.message += "Scan of jukebox directory '%s' started. " % myroot
+        else:
+            self.message += "Scan of jukebox directory '%s' already in progress. " % myroot
 
     def _do_reset_form(self):
         """clear search form"""
@@ -872,23 +1054,27 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 
     def _do_shuffle(self):
         """randomize playlist order"""
-        oldlist = [i.data for i in proxy.list()]
+        oldlist = queue.get(fresh=True)
+        temp    = oldlist[:]
         newlist = []
-        while oldlist:
-            index = random.randint(0,len(oldlist)-1)
-            newlist.append(oldlist[index])
-            del oldlist[index]
-        proxy.replace([Binary(i) for i in newlist])
+        while temp:
+            index = random.randint(0,len(temp)-1)
+            newlist.append(temp[index])
+            del temp[index]
+        change_queue(oldlist, newlist, self.state.is_queue_running())
 
     def _do_skip(self):
         """skip forward/backward a given number of tracks"""
-        if self.is_looping and not self.queue_length:
+        before = self.state.snapshot()
+        if self.state.is_looping() and not self.state.queue_length():
             self.message += "The playlist is currently empty. "
         elif self.count > 0:
             self.next(self.count)
+            self.expect = lambda status: player_settled(status, before)
             self.message += "Command 'skip(%s)' executed. " % (self.count)
         elif self.count < 0:
             self.previous(-self.count)
+            self.expect = lambda status: player_settled(status, before)
             self.message += "Command 'skip(%s)' executed. " % (self.count)
         else:
             self.message += "Weird error -- no count given for skip. "
@@ -900,6 +1086,7 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     def _do_stop(self):
         """stop command"""
         proxy.stop()
+        self.expect = lambda status: not status["current"]
 
     def _do_tree(self):
         """switch to tree view mode"""
@@ -913,6 +1100,8 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         """
         if self.count and self.file:
             # stop forwarding in order no to mess things up
+            running = self.state.is_queue_running()
+            before = self.state.snapshot()
             proxy.halt_queue()
             count = self.count
             file  = self.file
@@ -938,9 +1127,10 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
             else:
                 self.message += "No tracks skipped. How did you come here anyway? "
             # start forwarding if it was previously enabled
-            if self.is_queue_running:
+            if running:
                 proxy.run_queue()
-                time.sleep(0.05)
+                self.legacy += 0.05
+            self.expect = lambda status: player_settled(status, before)
         else:
             self.message += "Weird error -- no count or filename given for skip. "
 
@@ -948,7 +1138,7 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 
     def cont_standard(self):
         """prepare contents for standard view mode: playlist and history"""
-        playlist = [i.data for i in proxy.list()[:10]]
+        playlist = fetch_queue(0, 10)
         content  = ['<table border="0" width="100%" cellspacing="0" cellpadding="0"><tr><td width="50%" valign="top">\n']
         content.append('<table class="menu" border="0" width="100%" cellspacing="0">\n')
         content.append('<tr><th colspan="2" align="left">Playlist</th></tr>\n')
@@ -961,13 +1151,12 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         content.append("</table>\n")
         content.append('</td><td width="1%"> </td>\n')
 
-        history = proxy.history(10)
-        history.reverse()
+        history = fetch_history(10)
         content.append('<td width="49%" valign="top"><table class="menu" border="0" width="100%" cellspacing="0">\n')
         content.append('<tr><th colspan="2" align="left">History</th></tr>\n')
         i=-1
         for f in history:
-            content.append('<tr><td class="%s" valign="top" align="right">[%d]&nbsp;&nbsp;&nbsp;</td><td class="%s" width="95%%">%s</td></tr>\n' % (klass[i & 1],i,klass[i & 1],format_name("%s" % f[0])))
+            content.append('<tr><td class="%s" valign="top" align="right">[%d]&nbsp;&nbsp;&nbsp;</td><td class="%s" width="95%%">%s</td></tr>\n' % (klass[i & 1],i,klass[i & 1],format_name(f)))
             i -=1
         if not history:
             content.append('<tr><td colspan="2">(The history buffer is currently empty.)</td></tr>\n')
@@ -977,8 +1166,11 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 
     def cont_history(self):
         """prepare contents for history view mode"""
-        history = proxy.history()
-        history.reverse()
+        if self.pattern:
+            files = fetch_history()
+        else:
+            # there is no point in fetching more than we are going to show
+            files = fetch_history(limit)
         content = ['<table class="menu" border="0" width="100%" cellspacing="0">\n']
         content.append('<tr><th width="90%" align="left" valign="middle">History</th>\n')
         content.append('<th align="right" valign="middle">%s</th><th valign="middle">@@cform</th></tr>\n' % (search_form % ("refresh", self.view, self.mypath, self.pattern,"search history")))
@@ -986,8 +1178,7 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         content.append('<table class="menu" border="0" width="100%" cellspacing="0">\n')
         i=-1
         count = 0
-        files = [str(f[0]) for f in history]
-        looping = proxy.is_looping()
+        looping = self.state.is_looping()
         for f in files:
             if match(f[len(myroot):], string.translate(self.pattern, xlat)):
                 content.append('<tr>')
@@ -1003,7 +1194,7 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
                 content.append('</tr>')
                 count += 1
             i -= 1
-        if not history:
+        if not files:
             content.append('<tr><td colspan="6">(The history buffer is currently empty.)</td></tr>\n')
         elif count == 0:
             content.append('''<tr><td colspan="6">(no entries in history matching '%s')</td></tr>\n''' % self.pattern)
@@ -1012,7 +1203,11 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 
     def cont_playlist(self):
         """prepare contents for playlist view mode"""
-        playlist = [i.data for i in proxy.list()]
+        if self.pattern:
+            playlist = queue.get()
+        else:
+            # there is no point in fetching more than we are going to show
+            playlist = fetch_queue(0, limit)
         content = ['<table class="menu" border="0" width="100%" cellspacing="0">\n']
         content.append('<tr><th width="90%" align="left" valign="middle">Playlist @@LIMIT</th>\n')
         content.append('<th align="right" valign="middle">%s</th><th valign="middle">@@cform</th></tr>\n' % (search_form % ("refresh", self.view, self.mypath, self.pattern,"search playlist" )))
@@ -1020,6 +1215,7 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         content.append('<table class="menu" border="0" width="100%" cellspacing="0">\n')
         i = 1
         count = 0
+        looping = self.state.is_looping()
         for f in playlist:
             if match(f[len(myroot):], string.translate(self.pattern, xlat)):
                 if count < limit:
@@ -1027,7 +1223,7 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
                     content.append('<td class="%s" valign="top" align="right">[%d]&nbsp;&nbsp;&nbsp;</td>\n' % (klass[count & 1],i))
                     content.append('<td class="%s" width="60%%" valign="top">%s</td>\n' % (klass[count & 1],format_name(f)))
                     content.append('<td class="%s" valign="top"><a href="tskip?@@params&amp;count=%d&amp;file=%s">skip</a>&nbsp;</td>\n' % (klass[count & 1],i, urllib.quote(f)))
-                    if proxy.is_looping():
+                    if looping:
                         content.append('<td class="%s"> </td>' % klass[count & 1])
                     else:
                         content.append('<td class="%s" valign="top"><a href="play_now?@@params&amp;file=%s">play</a>&nbsp;</td>\n' % (klass[count & 1],urllib.quote(f)))
@@ -1037,6 +1233,8 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
                     content.append('</tr>')
                 count += 1
             i += 1
+        if not self.pattern:
+            count = max(count, self.state.queue_length())
         if not playlist:
             content.append('<tr><td colspan="7">(The playlist is currently empty.)</td></tr>\n')
         elif count == 0:
@@ -1055,9 +1253,8 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     def cont_files(self):
         """prepare contents for file view mode"""
 
-        files = tree[self.mypath]
-        dirs = [dir for dir in tree.keys() if parent[dir]==self.mypath]
-        dirs.sort()
+        files = library.files(self.mypath)
+        dirs = library.children(self.mypath)
         temp=string.split(myroot,"/")
         temp = temp.pop()
         temp = temp + self.mypath[len(myroot):]
@@ -1076,7 +1273,7 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         count = 0
         for f in dirs:
              if string.find(f,"/.") < 0:
-                nfiles = length[f]
+                nfiles = library.length(f)
                 dir = string.split(f,"/").pop()
                 content.append('<tr>')
                 content.append('<td class="%s" width="40%%" valign="top"><a href="chdir?@@params&amp;dir=%s">%s</a></td>\n' % (klass[count & 1],urllib.quote(f), dir))
@@ -1092,15 +1289,18 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         content.append('<tr><td colspan="6">&nbsp;</td></tr>\n')
         content.append("</table>\n")
 
+        content.append(batch_form % (self.view, cgi.escape(self.mypath, True), cgi.escape(self.pattern, True)))
         content.append('<table class="menu" border="0" width="100%" cellspacing="0">\n')
-        content.append('<tr><td class="thsub" align="left" colspan="4"><i>Music files</i></td></tr>\n')
+        content.append('<tr><td class="thsub" align="left" colspan="5"><i>Music files</i></td></tr>\n')
         count = 0
+        looping = self.state.is_looping()
         for file in files:
             f = self.mypath + "/" + file
             if file_is_moosical(file) and f[:1] != ".":
                 content.append('<tr>\n')
+                content.append('<td class="%s" valign="top"><input type="checkbox" name="file" value="%s"></td>\n' % (klass[count & 1],cgi.escape(f, True)))
                 content.append('<td class="%s" width="40%%" valign="top">%s</td>\n' % (klass[count & 1],file))
-                if proxy.is_looping():
+                if looping:
                     content.append('<td class="%s">&nbsp;</td>' % klass[count & 1])
                 else:
                     content.append('<td class="%s" valign="top"><a href="play_now?@@params&amp;file=%s">play</a>&nbsp;</td>\n' % (klass[count & 1],urllib.quote(f)))
@@ -1110,16 +1310,17 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
                 count += 1
 
         if count == 0:
-            content.append('''<tr><td colspan="4">(no music files)</td></tr>\n''')
+            content.append('''<tr><td colspan="5">(no music files)</td></tr>\n''')
+        else:
+            content.append(batch_buttons % (5, looping and " disabled" or ""))
 
-        content.append("</table>\n")
+        content.append("</table>\n</form>\n")
 
         return ''.join(content)
 
     def cont_tree(self):
         """prepare contents for (directory) tree view mode"""
-        dirs = tree.keys()
-        dirs.sort()
+        dirs = library.alldirs()
         content =  ['<table class="menu" border="0" width="100%" cellspacing="0">\n']
         content.append('<tr><th align="left" colspan="5">Jukebox directory %s</th></tr>\n' % myroot)
         count = 0
@@ -1130,7 +1331,7 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
             depth = len(chunks) - len(temp)
             content.append('<tr>\n')
             content.append('<td class="%s" width="70%%" valign="top">%s<a href="chdir?@@params&amp;dir=%s">%s</a></td>\n' % (klass[count & 1], '&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;' * depth, urllib.quote(dir), last))
-            content.append('<td class="%s" valign="top" align="right">%d&nbsp;music&nbsp;files&nbsp;&nbsp;&nbsp;</td>\n' % (klass[count & 1],length[dir]))
+            content.append('<td class="%s" valign="top" align="right">%d&nbsp;music&nbsp;files&nbsp;&nbsp;&nbsp;</td>\n' % (klass[count & 1],library.length(dir)))
             content.append('<td class="%s" valign="top"><a href="mixin?@@params&amp;dir=%s">mixin</a>&nbsp;</td>\n' % (klass[count & 1],urllib.quote(dir)))
             content.append('<td class="%s" valign="top"><a href="add_top?@@params&amp;dir=%s">prepend</a>&nbsp;</td>\n' % (klass[count & 1],urllib.quote(dir)))
             content.append('<td class="%s" valign="top"><a href="add_bottom?@@params&amp;dir=%s">append</a>&nbsp;</td>\n' % (klass[count & 1],urllib.quote(dir)))
@@ -1142,31 +1343,13 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 
     def cont_search(self):
         """prepare contents for search view mode"""
-        dirs = tree.keys()
-        dirs.sort()
-        mdirs = []
-        mfiles = []
-        mpattern = string.translate(self.pattern,xlat)
+        dirs, files = self.search(limit)
+        mdirs = dirs["items"]
+        mfiles = files["items"]
         content = ['<table class="menu" border="0" width="100%" cellspacing="0">\n']
         content.append('''<tr><th align="left" colspan="5">Search result for '%s'</th></tr>\n''' % self.pattern)
-        for dir in dirs:
-            if string.find(dir,"/.") < 0:
-                temp = string.split(dir,"/")
-                temp = temp.pop()
-                if match(temp, mpattern):
-                    mdirs.append(dir)
-                files = tree[dir]
-                for file in files:
-                    if file_is_moosical(file) and file[:1] != "." \
-                            and match(file, mpattern):
-                        mfiles.append(dir + "/" + file)
-
-        ndirs = len(mdirs)
-        if ndirs > limit:
-            mdirs = mdirs[0:limit]
-            content.append('<tr><td class="thsub" colspan="5"><i>Directories (showing %d of %d matches.)</i></td></tr>\n' % (limit, ndirs))
-        else:
-            content.append('<tr><td class="thsub" colspan="5"><i>Directories (%d matches.)</i></td></tr>\n' % (ndirs))
+
+        content.append('<tr><td class="thsub" colspan="5"><i>Directories %s</i></td></tr>\n' % self.result_info(dirs))
 
         count = 0
         for dir in mdirs:
@@ -1176,7 +1359,7 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
             depth = len(chunks) - len(temp)
             content.append('<tr>\n')
             content.append('<td class="%s" width="70%%" valign="top"><a href="chdir?@@params&amp;dir=%s">%s</td>\n' % (klass[count & 1],urllib.quote(dir), format_name(dir)))
-            content.append('<td class="%s" valign="top" align="right">%d&nbsp;music&nbsp;files&nbsp;&nbsp;</td>\n' % (klass[count & 1],length[dir]))
+            content.append('<td class="%s" valign="top" align="right">%d&nbsp;music&nbsp;files&nbsp;&nbsp;</td>\n' % (klass[count & 1],library.length(dir)))
             content.append('<td class="%s" valign="top"><a href="mixin?@@params&amp;dir=%s">mixin</a>&nbsp;</td>\n' % (klass[count & 1],urllib.quote(dir)))
             content.append('<td class="%s" valign="top"><a href="add_top?@@params&amp;dir=%s">prepend</a>&nbsp;</td>\n' % (klass[count & 1],urllib.quote(dir)))
             content.append('<td class="%s" valign="top"><a href="add_bottom?@@params&amp;dir=%s">append</a>&nbsp;</td>\n' % (klass[count & 1],urllib.quote(dir)))
@@ -1187,18 +1370,25 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         content.append('<tr><td colspan="5">&nbsp;</td></tr>\n')
         content.append("</table>\n")
 
+        content.append(batch_form % (self.view, cgi.escape(self.mypath, True), cgi.escape(self.pattern, True)))
         content.append('<table class="menu" border="0" width="100%" cellspacing="0">\n')
         nfiles = len(mfiles)
-        if nfiles > limit:
-            mfiles = mfiles[0:limit]
-            content.append('<tr><td class="thsub" colspan="4"><i>Music files (showing %d of %d matches.)</i></td></tr>\n' % (limit, nfiles))
+        if nfiles:
+            # keep the pattern for "append all" and friends
+            result = search_results.add(search_key(self.pattern))
+            batch_all = '<a href="batch?@@params&amp;result=%d&amp;action=append">append all</a> ' \
+                  '<a href="batch?@@params&amp;result=%d&amp;action=prepend">prepend all</a>' % (result, result)
         else:
-            content.append('<tr><td class="thsub" colspan="4"><i>Music files (%d matches.)</i></td></tr>\n' % (nfiles))
+            batch_all = '&nbsp;'
+        content.append('<tr><td class="thsub" colspan="3"><i>Music files %s</i></td>' % self.result_info(files))
+        content.append('<td class="thsub" align="right" colspan="2">%s</td></tr>\n' % batch_all)
         count = 0
+        looping = self.state.is_looping()
         for file in mfiles:
             content.append('<tr>\n')
+            content.append('<td class="%s" valign="top"><input type="checkbox" name="file" value="%s"></td>\n' % (klass[count & 1],cgi.escape(file, True)))
             content.append('<td class="%s" width="80%%" valign="top">%s</td>\n' % (klass[count & 1],format_name(file)))
-            if proxy.is_looping():
+            if looping:
                 content.append('<td class="%s"> </td>' % (klass[count & 1]))
             else:
                 content.append('<td class="%s" valign="top"><a href="play_now?@@params&amp;file=%s">play</a>&nbsp;</td>\n' % (klass[count & 1],urllib.quote(file)))
@@ -1207,12 +1397,157 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
             content.append('</tr>')
             count += 1
         if nfiles == 0:
-            content.append('<tr><td colspan="4">(no files found)</td></tr>\n')
-        content.append("</table>\n")
+            content.append('<tr><td colspan="5">(no files found)</td></tr>\n')
+        else:
+            content.append(batch_buttons % (5, looping and " disabled" or ""))
+        content.append("</table>\n</form>\n")
         return ''.join(content)
 
+    def result_info(self, result):
+        """number of matches shown and links to the other pages of search result"""
+        start = result["start"]
+        shown = len(result["items"])
+        total = result.get("total")
+        if total is not None and (not shown or not start and shown == total):
+            info = "(%d matches.)" % total
+        elif total is not None:
+            info = "(showing %d-%d of %d matches.)" % (start + 1, start + shown, total)
+        elif result.has_key("at_most"):
+            info = "(showing %d-%d of at most %d matches.)" % (start + 1, start + shown, result["at_most"])
+        else:
+            info = "(showing %d-%d, more matches.)" % (start + 1, start + shown)
+        # keep counting on the other pages if asked to
+        count = self.total and "&amp;total=1" or ""
+        if start:
+            info += ' <a href="search?@@params&amp;start=%d%s">previous</a>' % (max(start - limit, 0), count)
+        if result["more"]:
+            info += ' <a href="search?@@params&amp;start=%d%s">next</a>' % (start + limit, count)
+        if total is None:
+            info += ' <a href="search?@@params&amp;start=%d&amp;total=1">count</a>' % start
+        return info
+
     #-------------------------------------------
 
+    def api_answer(self, command):
+        """write status, message and data of selected view as JSON object"""
+        answer = {
+            "command": command,
+            "message": plain_text(self.message),
+            "status":  {
+                "advancing":    bool(self.state.is_queue_running()),
+                "looping":      bool(self.state.is_looping()),
+                "paused":       bool(self.state.is_paused()),
+                "queue_length": self.state.queue_length(),
+                "current":      self.state.current(),
+                "current_time": self.state.current_time(),
+                "version":      self.state.version(),
+            },
+            "view": self.view,
+        }
+        if rescanner.running():
+            answer["scan"] = rescanner.progress.state()
+        answer.update(self.data)
+        if self.view != "standard":
+            meth = getattr(self, "api_" + self.view)
+            index_lock.acquire_read()
+            try:
+                answer[self.view] = meth()
+            finally:
+                index_lock.release_read()
+        self.send_response(200, 'Script output follows')
+        self.wfile.write('Content-type: application/json\n\n')
+        self.wfile.write(json_dumps(answer))
+
+    def api_page(self, items, total=None):
+        """slice [start:start+size] of items with paging information"""
+        if total is None:
+            total = len(items)
+        return {"start": self.start, "total": total,
+                "items": items[self.start:self.start+self.size]}
+
+    def api_playlist(self):
+        """(matching) entries of playlist"""
+        if self.pattern:
+            pattern = string.translate(self.pattern, xlat)
+            return self.api_page([f for f in queue.get() if match(f[len(myroot):], pattern)])
+        page = self.api_page([], self.state.queue_length())
+        if self.size:
+            page["items"] = fetch_queue(self.start, self.start + self.size)
+        return page
+
+    def api_history(self):
+        """(matching) entries of history, latest first"""
+        if self.pattern:
+            pattern = string.translate(self.pattern, xlat)
+            return self.api_page([f for f in fetch_history() if match(f[len(myroot):], pattern)])
+        # one entry more tells whether the page is the last one
+        history = fetch_history(self.start + self.size + 1)
+        page = self.api_page(history)
+        if len(history) > self.start + self.size:
+            # the length of the history is unknown without fetching all of it
+            page["total"] = None
+        return page
+
+    def api_files(self):
+        """subdirectories and music files of current working directory"""
+        dirs = library.children(self.mypath)
+        files = [self.mypath + "/" + file for file in library.files(self.mypath)]
+        return {"path": self.mypath,
+                "dirs": self.api_page([{"path": dir, "files": library.length(dir)} for dir in dirs]),
+                "files": self.api_page(files)}
+
+    def api_tree(self):
+        """all directories of jukebox directory"""
+        return self.api_page([{"path": dir, "files": library.length(dir)} for dir in library.alldirs()])
+
+    def api_search(self):
+        """directories and music files matching search pattern"""
+        dirs, files = self.search(self.size)
+        dirs["items"] = [{"path": dir, "files": library.length(dir)} for dir in dirs["items"]]
+        return {"pattern": self.pattern, "dirs": dirs, "files": files}
+
+    def search(self, count):
+        """
+        page of directories and one of music files matching search
+        pattern, count entries each from self.start on (see result_page())
+        """
+        dirs, files = search_cache.get(search_key(self.pattern))
+        return (self.result_page(dirs, count, library.dir_paths),
+                self.result_page(files, count, library.file_paths))
+
+    def result_page(self, matches, count, paths):
+        """
+        count of the matches (see class Matches) from self.start on,
+        looking no further than needed: start, items (paths), whether
+        there are more and the number of matches if known (always if
+        self.total) or else at most how many there are, if known
+        """
+        found = matches.get(self.start + count + 1)
+        more = len(found) > self.start + count
+        result = {"start": self.start, "items": paths(found[self.start:self.start+count]),
+                  "more": more}
+        if self.total or not more:
+            result["total"] = matches.count()
+        elif matches.most is not None:
+            result["at_most"] = matches.most
+        return result
+
+    def confirm(self, expected, deadline=0.5):
+        """
+        wait until moosicd's status satisfies expected(status): poll with
+        a short backoff and give up after deadline seconds
+        """
+        start = time.time()
+        delay = 0.005
+        while True:
+            status = poller.refresh()
+            if expected(status) or time.time() + delay > start + deadline:
+                break
+            time.sleep(delay)
+            delay = min(2 * delay, 0.1)
+        self.waited += time.time() - start
+        self.state.invalidate()
+
     def listPL(self, file):
         """list content of playlist (without .m3u specific comments)"""
         print "PL FILE", file
@@ -1222,6 +1557,8 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
             self.message += "Can not read playlist '%s'. " % file
         else:
             lines = [line for line in lines if line[:1] != '#']
+            self.data["playlist_file"] = {"path": file,
+                                          "entries": self.api_page([string.strip(line) for line in lines])}
             content = ['<table class="menu" border="0" width="100%" cellspacing="0">\n']
             content.append('''<tr><th align="left">Content of playlist '%s'</th></tr>\n''' % file[len(myroot)+1:])
             count = 0
@@ -1245,16 +1582,15 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
         """move selected file to top or bottom of playlist or remove file from playlist"""
         if self.file:
             # stop forwarding in order no to mess things up
+            running = self.state.is_queue_running()
             proxy.halt_queue()
             pos  = self.pos
             file = self.file
             # seek new offset in case check playlist changed
             offset = self.offset_plist(pos, file)
             if offset >= 0:
-                try:
-                    playlist=self.playlist
-                except AttributeError:
-                    playlist = [i.data for i in proxy.list()]
+                oldlist  = queue.get(fresh=True)
+                playlist = oldlist[:]
                 del playlist[offset]
                 if new > 0:
                     playlist = playlist + [file]
@@ -1264,13 +1600,14 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
                     self.message += "Track '%s' will be played next. " % format_name(file)
                 else:
                     self.message += "Track '%s' removed from playlist. " % format_name(file)
-                proxy.replace([Binary(i) for i in playlist])
+                # the queue is halted already
+                change_queue(oldlist, playlist, False)
             else:
                 self.message += """<font color="#880000">The requested file '%s' is not
                                     available at the assumed position in the playlist and
                                     seems to have been played recently. </font>""" % format_name(file)
             # start forwarding if it was previously enabled
-            if self.is_queue_running:
+            if running:
                 proxy.run_queue()
         else:
             self.message += "Weird error -- no count or filename given. "
@@ -1287,20 +1624,24 @@ class moosicWebGUIHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
 
     def offset_hist(self, pos, file):
         """seek new offset of file in history"""
-        history = proxy.history()
-        history.reverse()
-        max = len(history)
-        while pos < max:
-            entry = history[pos]
-            hfile = str(entry[0])
-            if file == hfile:
-                return pos
-            pos += 1
-        return -1
+        # the file moves back in history as tracks are played, so we
+        # fetch a few more entries than pos first and more if need be
+        count = pos + 10
+        while True:
+            history = fetch_history(count)
+            max = len(history)
+            while pos < max:
+                if file == history[pos]:
+                    return pos
+                pos += 1
+            if max < count:
+                return -1
+            count = 2 * count
 
     def offset_plist(self, pos, file):
         """seek new offset of file in playlist"""
-        plist = [i.data for i in proxy.list()]
+        plist = fetch_queue(0, pos + 1)
+        pos = min(pos, len(plist) - 1)
         while pos >= 0:
             if file == plist[pos]:
                 return pos
@@ -1380,6 +1721,1308 @@ class subnet:
     def __repr__(self):
         return self.__str__()
 
+class moosicWebGUIHTTPServer(BaseHTTPServer.HTTPServer):
+    """
+    HTTP server handing accepted requests over to a fixed pool of
+    worker threads, so one slow request does not block all other
+    browsers.
+    """
+
+    # handle_request() returns after this many seconds without a request,
+    # so the main loop notices an exit request set by a worker thread
+    timeout = 0.5
+
+    def __init__(self, server_address, RequestHandlerClass, workers):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, RequestHandlerClass)
+        self.requests = Queue.Queue()
+        self.detached = {}      # requests served elsewhere, kept open
+        self.workers  = []
+        for i in range(max(workers, 1)):
+            worker = threading.Thread(target=self.process_requests)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def process_request(self, request, client_address):
+        """pass request on to the next idle worker thread"""
+        self.requests.put((request, client_address))
+
+    def process_requests(self):
+        """worker thread: serve requests until server is closed"""
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            if self.detached.pop(request, None) is None:
+                self.shutdown_request(request)
+
+    if not hasattr(BaseHTTPServer.HTTPServer, "shutdown_request"):
+        # Python 2.6
+        def shutdown_request(self, request):
+            self.close_request(request)
+
+    def detach(self, request):
+        """request is served by another thread, do not close it"""
+        self.detached[request] = True
+
+    def server_close(self):
+        """close socket, wait for workers to finish pending requests"""
+        BaseHTTPServer.HTTPServer.server_close(self)
+        for worker in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+
+class SerializedProxy:
+    """
+    Wrapper for the moosicd proxy: the XML-RPC connection is not
+    thread-safe, so calls from the worker threads are serialized.
+    Calls are counted per thread for debugging purposes.
+    """
+
+    # moosicd calls which do not change moosicd's state
+    readonly_calls = ("api_version", "current", "current_time", "get_history_limit",
+                      "history", "indexed_list", "is_looping", "is_paused",
+                      "is_queue_running", "last_queue_update", "length", "list",
+                      "no_op", "queue_length", "version")
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.lock  = threading.RLock()
+        self.local = threading.local()
+        # functions to call after a call changing moosicd's state
+        self.write_hooks = []
+
+    def __getattr__(self, name):
+        method = getattr(self.proxy, name)
+        def call(*args):
+            self.local.calls = getattr(self.local, "calls", 0) + 1
+            self.local.sent  = getattr(self.local, "sent", 0) + rpc_size(args)
+            self.lock.acquire()
+            try:
+                result = method(*args)
+            finally:
+                self.lock.release()
+                if name not in self.readonly_calls:
+                    for hook in self.write_hooks:
+                        hook(name)
+            return result
+        return call
+
+    def reset_rpc_count(self):
+        self.local.calls = 0
+        self.local.sent  = 0
+
+    def rpc_count(self):
+        """number of calls made by the current thread since last reset"""
+        return getattr(self.local, "calls", 0)
+
+    def bytes_sent(self):
+        """(estimated) size of these calls' requests"""
+        return getattr(self.local, "sent", 0)
+
+class moosicdState:
+    """
+    Request-scoped view of moosicd's state: the status snapshot is taken
+    from the status poller at most once per request, until a command
+    changing moosicd's state invalidates it.
+    """
+
+    def __init__(self):
+        self.facts = None
+
+    def get(self, name):
+        return self.snapshot()[name]
+
+    def snapshot(self):
+        if self.facts is None:
+            self.facts = poller.get()
+        return self.facts
+
+    def invalidate(self):
+        self.facts = None
+
+    def is_queue_running(self):
+        return self.get("is_queue_running")
+
+    def is_looping(self):
+        return self.get("is_looping")
+
+    def is_paused(self):
+        return self.get("is_paused")
+
+    def queue_length(self):
+        return self.get("queue_length")
+
+    def current(self):
+        return self.get("current")
+
+    def current_time(self):
+        return self.get("current_time")
+
+    def version(self):
+        return self.get("version")
+
+class StatusPoller(threading.Thread):
+    """
+    Background thread keeping a versioned snapshot of moosicd's status,
+    so page renders do not query moosicd themselves. A snapshot older
+    than ttl seconds or taken before our last write through the proxy
+    is refreshed on demand. The snapshot's queue_generation changes
+    whenever queue length, current track or latest history entry
+    change (whoever changed them) or we changed the queue.
+    """
+
+    facts = ("is_queue_running", "is_looping", "is_paused", "queue_length",
+             "current", "current_time")
+
+    def __init__(self, ttl):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.ttl      = ttl
+        self.cond     = threading.Condition()
+        self.snapshot = None
+        self.version  = 0
+        self.stamp    = 0.0
+        self.dirty    = True
+        self.queue_key        = None
+        self.queue_written    = False
+        self.queue_generation = 0
+
+    def poll(self):
+        """take a new snapshot (called with self.cond held)"""
+        snapshot = {}
+        for name in self.facts:
+            snapshot[name] = getattr(proxy, name)()
+        snapshot["current"] = snapshot["current"].data
+        history = proxy.history(1)
+        if history:
+            # with its end time: the same file may be played again
+            head = (history[0][0].data, history[0][2])
+        else:
+            head = None
+        snapshot["history_head"] = head
+        key = (snapshot["queue_length"], snapshot["current"], head)
+        if key != self.queue_key or self.queue_written:
+            self.queue_generation += 1
+        self.queue_key     = key
+        self.queue_written = False
+        snapshot["queue_generation"] = self.queue_generation
+        self.version += 1
+        snapshot["version"] = self.version
+        self.snapshot = snapshot
+        self.stamp    = time.time()
+        snapshot["stamp"] = self.stamp
+        self.dirty    = False
+        self.cond.notifyAll()
+        return snapshot
+
+    def refresh(self):
+        """return a new snapshot"""
+        self.cond.acquire()
+        try:
+            return self.poll()
+        finally:
+            self.cond.release()
+
+    def get(self):
+        """return a snapshot which is fresh enough"""
+        self.cond.acquire()
+        try:
+            if self.dirty or time.time() - self.stamp > self.ttl:
+                return self.poll()
+            return self.snapshot
+        finally:
+            self.cond.release()
+
+    def wait(self, version, timeout):
+        """return the first snapshot newer than version, None after timeout seconds"""
+        self.cond.acquire()
+        try:
+            deadline = time.time() + timeout
+            while self.version <= version:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+            return self.snapshot
+        finally:
+            self.cond.release()
+
+    def invalidate(self, name=None):
+        """moosicd's state was changed by us (call name), next get() polls again"""
+        self.cond.acquire()
+        self.dirty = True
+        if name in QueueMirror.queue_calls:
+            self.queue_written = True
+        self.cond.release()
+
+    def run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                try:
+                    self.poll()
+                except:
+                    # moosicd unreachable -- requests will tell the user
+                    self.dirty = True
+            finally:
+                self.cond.release()
+            time.sleep(self.ttl)
+
+class EventStream(threading.Thread):
+    """
+    Thread feeding the connections to /events: whenever the poller takes
+    a new snapshot, each client gets the fields changed since the last
+    event sent to it (the full status when connecting). Connections are
+    written without blocking, what a client does not take at once is
+    kept and sent later; a client falling too far behind is dropped.
+    """
+
+    keepalive = 15.0    # seconds without event before sending a comment
+    backlog   = 65536   # bytes kept for a client not reading
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.lock    = threading.Lock()
+        self.clients = {}       # connection -> [fields sent last, data not sent yet]
+
+    def status(self, snapshot):
+        """fields of an event"""
+        fields = {}
+        for name in StatusPoller.facts:
+            value = snapshot[name]
+            if name.startswith("is_"):
+                value = bool(value)
+            fields[name] = value
+        fields["queue_generation"] = snapshot["queue_generation"]
+        return fields
+
+    def send(self, connection, client, data):
+        """send data to one client as far as it takes it, drop it on errors"""
+        client[1] += data
+        try:
+            sent = connection.send(client[1])
+            client[1] = client[1][sent:]
+        except socket.error, e:
+            if e[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.drop(connection)
+                return
+        if len(client[1]) > self.backlog:
+            self.drop(connection)
+
+    def drop(self, connection):
+        self.lock.acquire()
+        try:
+            if self.clients.has_key(connection):
+                del self.clients[connection]
+        finally:
+            self.lock.release()
+        try:
+            connection.close()
+        except socket.error:
+            pass
+
+    def add(self, connection):
+        """new client, send full status"""
+        connection.setblocking(0)
+        fields = self.status(poller.get())
+        client = [fields, ""]
+        # not known to the event thread yet, nobody else writes to it
+        self.send(connection, client, "event: status\ndata: %s\n\n" % json_dumps(fields))
+        self.lock.acquire()
+        try:
+            self.clients[connection] = client
+        finally:
+            self.lock.release()
+
+    def run(self):
+        version = 0
+        while True:
+            snapshot = poller.wait(version, self.keepalive)
+            if snapshot is not None:
+                version = snapshot["version"]
+                fields  = self.status(snapshot)
+            self.lock.acquire()
+            try:
+                clients = self.clients.items()
+            finally:
+                self.lock.release()
+            for connection, client in clients:
+                if snapshot is None:
+                    data = ": keepalive\n\n"
+                else:
+                    changed = {}
+                    for name, value in fields.items():
+                        if client[0].get(name) != value:
+                            changed[name] = value
+                    data = ""
+                    if changed:
+                        client[0] = fields
+                        data = "event: status\ndata: %s\n\n" % json_dumps(changed)
+                if data or client[1]:
+                    self.send(connection, client, data)
+
+class QueueMirror:
+    """
+    Local copy of moosicd's queue. Before use the copy is validated
+    against the time of moosicd's last queue change, queue length,
+    current track and latest history entry, and fetched again only if
+    one of them changed. Changes made by us are applied to the copy in
+    place. Commands changing the queue plan from a fresh copy.
+    """
+
+    # moosicd calls changing the queue's content
+    queue_calls = ("append", "clear", "crop", "crop_list", "cut", "cut_list",
+                   "filter", "insert", "move", "move_list", "prepend", "putback",
+                   "remove", "replace", "replace_range", "reverse", "shuffle",
+                   "sort", "sub", "sub_all", "swap")
+
+    def __init__(self):
+        self.lock       = threading.RLock()
+        self.items      = None
+        self.key        = None
+        self.writes     = 0     # changes to the queue not applied to the copy
+
+    def fetch_key(self):
+        history = proxy.history(1)
+        if history:
+            head = str(history[0][0])
+        else:
+            head = ""
+        # a sort, shuffle or move by another client keeps the length
+        return (proxy.last_queue_update(), proxy.queue_length(), proxy.current().data, head)
+
+    def get(self, fresh=False):
+        """
+        return (a copy of) the queue's current content, fetched again if
+        fresh: another client may have changed the queue right after our
+        last change, unnoticed by the key taken after it
+        """
+        self.lock.acquire()
+        try:
+            key = self.fetch_key()
+            if fresh or self.items is None or self.writes or key != self.key:
+                self.items  = fetch_queue()
+                self.key    = key
+                self.writes = 0
+            return self.items[:]
+        finally:
+            self.lock.release()
+
+    def written(self, name):
+        """write hook: moosicd call name was made"""
+        if name in self.queue_calls:
+            self.lock.acquire()
+            self.writes += 1
+            self.lock.release()
+
+    def update(self, change, calls=1):
+        """
+        apply change to the copy after our last calls changed the queue --
+        unless the copy was outdated already, then it is dropped
+        """
+        self.lock.acquire()
+        try:
+            if self.items is not None and self.writes == calls:
+                change(self.items)
+                self.key        = self.fetch_key()
+                self.writes     = 0
+            else:
+                self.items = None
+        finally:
+            self.lock.release()
+
+    def replaced(self, items, calls=1):
+        def change(copy):
+            copy[:] = items
+        self.update(change, calls)
+
+    def appended(self, items, calls=1):
+        def change(copy):
+            copy.extend(items)
+        self.update(change, calls)
+
+    def prepended(self, items, calls=1):
+        def change(copy):
+            copy[0:0] = items
+        self.update(change, calls)
+
+class LatencyHistogram:
+    """
+    Per-command histogram of the time spent waiting for moosicd to carry
+    out a command, compared to the fixed delays we used to sleep instead.
+    """
+
+    bounds = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5)
+
+    def __init__(self):
+        self.lock     = threading.Lock()
+        self.commands = {}
+
+    def add(self, command, waited, legacy):
+        self.lock.acquire()
+        try:
+            if not self.commands.has_key(command):
+                self.commands[command] = [0, 0.0, 0.0, [0] * (len(self.bounds) + 1)]
+            entry = self.commands[command]
+            entry[0] += 1
+            entry[1] += waited
+            entry[2] += legacy - waited
+            i = 0
+            while i < len(self.bounds) and waited > self.bounds[i]:
+                i += 1
+            entry[3][i] += 1
+        finally:
+            self.lock.release()
+
+    def html(self):
+        """render histogram as html table"""
+        content = ['<table class="menu" border="0" width="100%" cellspacing="0">\n']
+        content.append('<tr><th align="left" colspan="%d">Time spent waiting for moosicd</th></tr>\n' % (len(self.bounds) + 5))
+        content.append('<tr><td class="thsub">command</td><td class="thsub" align="right">count</td>')
+        content.append('<td class="thsub" align="right">avg.&nbsp;wait</td><td class="thsub" align="right">saved</td>')
+        for bound in self.bounds:
+            content.append('<td class="thsub" align="right">&lt;=%dms</td>' % int(bound * 1000))
+        content.append('<td class="thsub" align="right">more</td></tr>\n')
+        self.lock.acquire()
+        try:
+            commands = self.commands.keys()
+            commands.sort()
+            count = 0
+            for command in commands:
+                calls, waited, saved, buckets = self.commands[command]
+                content.append('<tr><td class="%s">%s</td><td class="%s" align="right">%d</td>' % \
+                               (klass[count & 1], command, klass[count & 1], calls))
+                content.append('<td class="%s" align="right">%.1fms</td><td class="%s" align="right">%.1fs</td>' % \
+                               (klass[count & 1], 1000 * waited / calls, klass[count & 1], saved))
+                for bucket in buckets:
+                    content.append('<td class="%s" align="right">%d</td>' % (klass[count & 1], bucket))
+                content.append('</tr>\n')
+                count += 1
+        finally:
+            self.lock.release()
+        if not commands:
+            content.append('<tr><td colspan="%d">(no commands executed yet)</td></tr>\n' % (len(self.bounds) + 5))
+        content.append("</table>\n")
+        return ''.join(content)
+
+    def state(self):
+        """histogram per command: count, avg. and saved seconds, buckets"""
+        self.lock.acquire()
+        try:
+            commands = {}
+            for command, (calls, waited, saved, buckets) in self.commands.items():
+                commands[command] = {"count": calls, "wait": waited / calls,
+                                     "saved": saved, "buckets": buckets[:]}
+        finally:
+            self.lock.release()
+        return {"bounds": list(self.bounds), "commands": commands}
+
+class TrafficCounter:
+    """per-command count of moosicd calls and bytes sent to moosicd"""
+
+    def __init__(self):
+        self.lock     = threading.Lock()
+        self.commands = {}
+
+    def add(self, command, calls, sent):
+        self.lock.acquire()
+        try:
+            if not self.commands.has_key(command):
+                self.commands[command] = [0, 0, 0, 0]
+            entry = self.commands[command]
+            entry[0] += 1
+            entry[1] += calls
+            entry[2] += sent
+            entry[3] = max(entry[3], sent)
+        finally:
+            self.lock.release()
+
+    def html(self):
+        """render counters as html table"""
+        content = ['<table class="menu" border="0" width="100%" cellspacing="0">\n']
+        content.append('<tr><th align="left" colspan="5">Calls to moosicd (including status polls)</th></tr>\n')
+        content.append('<tr><td class="thsub">command</td><td class="thsub" align="right">count</td>')
+        content.append('<td class="thsub" align="right">avg.&nbsp;calls</td><td class="thsub" align="right">avg.&nbsp;bytes&nbsp;sent</td>')
+        content.append('<td class="thsub" align="right">max.&nbsp;bytes&nbsp;sent</td></tr>\n')
+        self.lock.acquire()
+        try:
+            commands = self.commands.keys()
+            commands.sort()
+            count = 0
+            for command in commands:
+                n, calls, sent, most = self.commands[command]
+                content.append('<tr><td class="%s">%s</td><td class="%s" align="right">%d</td>' % \
+                               (klass[count & 1], command, klass[count & 1], n))
+                content.append('<td class="%s" align="right">%.1f</td><td class="%s" align="right">%d</td>' % \
+                               (klass[count & 1], float(calls) / n, klass[count & 1], sent / n))
+                content.append('<td class="%s" align="right">%d</td></tr>\n' % (klass[count & 1], most))
+                count += 1
+        finally:
+            self.lock.release()
+        if not commands:
+            content.append('<tr><td colspan="5">(no commands executed yet)</td></tr>\n')
+        content.append("</table>\n")
+        return ''.join(content)
+
+    def state(self):
+        """counters per command: count, avg. calls and bytes, max. bytes"""
+        self.lock.acquire()
+        try:
+            commands = {}
+            for command, (n, calls, sent, most) in self.commands.items():
+                commands[command] = {"count": n, "calls": float(calls) / n,
+                                     "sent": sent / n, "max_sent": most}
+        finally:
+            self.lock.release()
+        return commands
+
+class SearchResults:
+    """
+    the latest search patterns (see search_key()), kept for batch
+    commands on all matches
+    """
+
+    def __init__(self, size=20):
+        self.lock    = threading.Lock()
+        self.size    = size
+        self.results = {}
+        self.last    = 0
+
+    def add(self, pattern):
+        """store pattern, return its id"""
+        self.lock.acquire()
+        try:
+            # the same search repeated gets the same id
+            if self.results.get(self.last) == pattern:
+                return self.last
+            self.last += 1
+            self.results[self.last] = pattern
+            if self.results.has_key(self.last - self.size):
+                del self.results[self.last - self.size]
+            return self.last
+        finally:
+            self.lock.release()
+
+    def get(self, id):
+        """stored pattern, None if unknown or expired"""
+        self.lock.acquire()
+        try:
+            return self.results.get(id)
+        finally:
+            self.lock.release()
+
+class ScanProgress:
+    """counters of a scan of the jukebox directory, read while it runs"""
+
+    def __init__(self, expected=0):
+        self.started   = time.time()
+        self.finished  = None
+        self.expected  = expected   # directories in the last index
+        self.read      = 0
+        self.unchanged = 0
+        self.files     = 0
+        self.error     = None
+
+    def add(self, scan, cached):
+        """count directory scanned (called by one walker at a time)"""
+        if cached:
+            self.unchanged += 1
+        else:
+            self.read += 1
+        self.files += len(scan[2])
+
+    def visited(self):
+        return self.read + self.unchanged
+
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def eta(self):
+        """estimated seconds to go, None if not known"""
+        visited = self.visited()
+        if self.finished is not None or not visited or visited >= self.expected:
+            return None
+        return self.elapsed() * (self.expected - visited) / visited
+
+    def state(self):
+        eta = self.eta()
+        if eta is not None:
+            eta = round(eta, 1)
+        return {"visited": self.visited(), "read": self.read, "unchanged": self.unchanged,
+                "files": self.files, "elapsed": round(self.elapsed(), 1), "eta": eta}
+
+    def text(self):
+        """progress as one line of text"""
+        text = "%d directories visited (%d read, %d unchanged), %d music files found in %.1f seconds" % \
+               (self.visited(), self.read, self.unchanged, self.files, self.elapsed())
+        if self.error is not None:
+            text += ", failed: %s" % self.error
+        eta = self.eta()
+        if eta is not None:
+            text += ", about %d seconds to go" % (eta + 0.5)
+        return text + ". "
+
+class Rescanner:
+    """
+    runs scans of the jukebox directory asked for by browsers (or at
+    start-up) in a background thread, one at a time
+    """
+
+    def __init__(self):
+        self.lock     = threading.Lock()
+        self.progress = None
+
+    def running(self):
+        progress = self.progress
+        return progress is not None and progress.finished is None
+
+    def start(self, changed=None):
+        """start a scan unless one is running, return true if started"""
+        self.lock.acquire()
+        try:
+            if self.running():
+                return False
+            self.progress = ScanProgress(len(library.dirs))
+            thread = threading.Thread(target=self.run, args=(changed, self.progress))
+            thread.setDaemon(True)
+            thread.start()
+            return True
+        finally:
+            self.lock.release()
+
+    def run(self, changed, progress):
+        try:
+            rescan(changed, progress)
+        except:
+            progress.error = str(sys.exc_info()[1])
+            progress.finished = time.time()
+            print >> sys.stderr, "\n+++ scan of jukebox directory failed: %s\n" % progress.error
+
+class Matches:
+    """
+    numbers of the matches of a search found so far, the iterator
+    matches finds more as they are asked for; most is an upper bound
+    of their number (None if unknown), grown is called after more were
+    found
+    """
+
+    def __init__(self, matches, most=None, grown=None):
+        self.lock  = threading.Lock()
+        self.found = []
+        self.rest  = matches
+        self.most  = most
+        self.grown = grown
+
+    def get(self, end):
+        """the first end matches, fewer if there are not as many"""
+        more = None
+        self.lock.acquire()
+        try:
+            if self.rest is not None and len(self.found) < end:
+                wanted = end - len(self.found)
+                more = list(itertools.islice(self.rest, wanted))
+                self.found.extend(more)
+                if len(more) < wanted:
+                    self.rest = None
+            found = self.found[:end]
+        finally:
+            self.lock.release()
+        if more and self.grown is not None:
+            self.grown()
+        return found
+
+    def count(self):
+        """number of matches, all of them are found for that"""
+        while self.rest is not None:
+            self.get(len(self.found) + 10000)
+        return len(self.found)
+
+class SearchCache:
+    """
+    matches of the latest searches by search key, least recently used
+    ones are dropped beyond size searches or ids numbers found; all of
+    them when the library is replaced
+    """
+
+    def __init__(self, size=32, ids=1000000):
+        self.lock       = threading.Lock()
+        self.size       = size
+        self.ids        = ids
+        self.entries    = {}
+        self.generation = 0
+        self.tick       = 0
+        self.hits       = 0
+        self.misses     = 0
+        self.dropped    = 0
+        self.cleared    = 0
+
+    def get(self, pattern):
+        """
+        Matches of directories and music files for pattern, call with
+        the index lock held. The library is searched without holding
+        our lock, searches for other patterns go on meanwhile.
+        """
+        self.lock.acquire()
+        try:
+            if self.generation != generation:
+                if self.entries:
+                    self.cleared += 1
+                self.entries = {}
+                self.generation = generation
+            self.tick += 1
+            entry = self.entries.get(pattern)
+            if entry is not None:
+                self.hits += 1
+                entry[0] = self.tick
+                return entry[1], entry[2]
+            self.misses += 1
+        finally:
+            self.lock.release()
+        dirs, files, ndirs, nfiles = library.matching(pattern)
+        found = [0, Matches(dirs, ndirs, self.grown), Matches(files, nfiles, self.grown)]
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(pattern)
+            if entry is None:
+                # unless a concurrent search for pattern came first
+                entry = found
+                if self.generation == generation:
+                    self.entries[pattern] = entry
+            self.tick += 1
+            entry[0] = self.tick
+            self.trim()
+            return entry[1], entry[2]
+        finally:
+            self.lock.release()
+
+    def grown(self):
+        """more matches of an entry were found: keep to the limits"""
+        self.lock.acquire()
+        try:
+            self.trim()
+        finally:
+            self.lock.release()
+
+    def held(self):
+        """number of ids held"""
+        count = 0
+        for tick, dirs, files in self.entries.values():
+            count += len(dirs.found) + len(files.found)
+        return count
+
+    def trim(self):
+        """drop least recently used entries but the latest beyond limits"""
+        while len(self.entries) > 1 and \
+                (len(self.entries) > self.size or self.held() > self.ids):
+            oldest = None
+            for pattern, entry in self.entries.items():
+                if oldest is None or entry[0] < self.entries[oldest][0]:
+                    oldest = pattern
+            del self.entries[oldest]
+            self.dropped += 1
+
+    def rows(self):
+        """counters as (description, value, api name)"""
+        self.lock.acquire()
+        try:
+            return [("searches cached", len(self.entries), "cached"),
+                    ("matches held", self.held(), "held"),
+                    ("hits", self.hits, "hits"),
+                    ("misses", self.misses, "misses"),
+                    ("dropped (least recently used)", self.dropped, "dropped"),
+                    ("cleared (index replaced)", self.cleared, "cleared")]
+        finally:
+            self.lock.release()
+
+    def state(self):
+        state = {}
+        for name, value, key in self.rows():
+            state[key] = value
+        return state
+
+    def html(self):
+        """render counters as html table"""
+        rows = self.rows()
+        content = ['<table class="menu" border="0" width="100%" cellspacing="0">\n']
+        content.append('<tr><th align="left" colspan="2">Search cache</th></tr>\n')
+        count = 0
+        for name, value, key in rows:
+            content.append('<tr><td class="%s">%s</td><td class="%s" align="right">%d</td></tr>\n' % \
+                           (klass[count & 1], name, klass[count & 1], value))
+            count += 1
+        content.append("</table>\n")
+        return ''.join(content)
+
+class IndexWatcher(threading.Thread):
+    """
+    Background thread keeping the index current: with pyinotify the
+    directories changed are collected until things calm down and then
+    read again, else all directories are checked every interval seconds.
+    """
+
+    quiet   = 2.0       # seconds without events before rescanning
+    longest = 30.0      # max. seconds to wait for a quiet moment
+
+    def __init__(self, interval):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.interval = interval
+
+    def rescan(self, changed=None):
+        try:
+            progress = rescan(changed)
+            if debug:
+                print "--- index updated: %d directories read, %d unchanged" % (progress.read, progress.unchanged)
+        except:
+            print >> sys.stderr, "\n+++ updating index of jukebox directory failed: %s\n" % sys.exc_info()[1]
+
+    def run(self):
+        if pyinotify is None:
+            while True:
+                time.sleep(self.interval)
+                self.rescan()
+        else:
+            self.watch()
+
+    def watch(self):
+        changed = {}
+        def collect(event):
+            if event.mask & pyinotify.IN_Q_OVERFLOW:
+                # events lost, look at everything
+                changed[None] = True
+            else:
+                changed[event.path] = True
+        manager  = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(manager, collect, timeout=int(self.quiet * 1000))
+        mask = pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM | \
+               pyinotify.IN_MOVED_TO | pyinotify.IN_DELETE_SELF
+        manager.add_watch(myroot, mask, rec=True, auto_add=True)
+        # catch up with changes made while we were not watching
+        self.rescan()
+        first = None
+        while True:
+            if notifier.check_events():
+                notifier.read_events()
+                notifier.process_events()
+                if first is None:
+                    first = time.time()
+                if time.time() - first < self.longest:
+                    continue
+            if changed:
+                if changed.has_key(None):
+                    self.rescan()
+                else:
+                    self.rescan(changed.copy())
+                changed.clear()
+            first = None
+
+class StringTable:
+    """
+    read-only sequence of strings kept in one string plus offsets; the
+    string may as well be part of a memory mapped file, starting at base
+    """
+
+    def __init__(self, strings=None, data="", offsets=None, base=0):
+        if strings is not None:
+            offsets = array.array('I', [0])
+            total   = 0
+            for s in strings:
+                total += len(s)
+                offsets.append(total)
+            data = "".join(strings)
+        elif offsets is None:
+            offsets = array.array('I', [0])
+        self.data    = data
+        self.offsets = offsets
+        self.base    = base
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return [self[j] for j in xrange(start, stop, step)]
+            if stop <= start:
+                return []
+            offsets = self.offsets[start:stop+1]
+            data = self.data[self.base + offsets[0]:self.base + offsets[-1]]
+            first = offsets[0]
+            return [data[offsets[j]-first:offsets[j+1]-first] for j in xrange(len(offsets) - 1)]
+        n = len(self.offsets) - 1
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError(i)
+        offsets = self.offsets
+        return self.data[self.base + offsets[i]:self.base + offsets[i+1]]
+
+    def content(self):
+        """the strings as one string"""
+        return self.data[self.base:self.base + self.offsets[len(self)]]
+
+    def find(self, pattern):
+        """numbers of the strings containing pattern, found as asked for"""
+        if not pattern:
+            for i in xrange(len(self)):
+                yield i
+            return
+        if isinstance(self.offsets, MappedArray):
+            # the strings are searched in one go, read the offsets at once
+            self.offsets = self.offsets.load()
+        data    = self.data
+        base    = self.base
+        offsets = self.offsets
+        end     = base + offsets[len(self)]
+        pos = data.find(pattern, base, end)
+        while pos >= 0:
+            i = bisect.bisect_right(offsets, pos - base) - 1
+            stop = base + offsets[i+1]
+            if pos + len(pattern) <= stop:
+                yield i
+                pos = data.find(pattern, stop, end)
+            else:
+                # runs into the next string
+                pos = data.find(pattern, pos + 1, end)
+
+class MappedArray:
+    """read-only array of numbers in a memory mapped file"""
+
+    def __init__(self, buffer, offset, typecode, count):
+        self.buffer   = buffer
+        self.offset   = offset
+        self.typecode = typecode
+        self.item     = struct.Struct("=" + typecode)
+        self.itemsize = self.item.size
+        self.count    = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if type(i) is int and 0 <= i < self.count:
+            return self.item.unpack_from(self.buffer, self.offset + i * self.itemsize)[0]
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.count)
+            if step != 1:
+                return [self[j] for j in xrange(start, stop, step)]
+            if stop <= start:
+                return []
+            return list(struct.unpack_from("=%d%s" % (stop - start, self.typecode),
+                                           self.buffer, self.offset + start * self.itemsize))
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError(i)
+        return self.item.unpack_from(self.buffer, self.offset + i * self.itemsize)[0]
+
+    def tostring(self):
+        return self.buffer[self.offset:self.offset + self.count * self.itemsize]
+
+    def load(self):
+        """copy of the numbers as array"""
+        numbers = array.array(self.typecode)
+        numbers.fromstring(self.tostring())
+        return numbers
+
+class Library:
+    """
+    Index of the jukebox directory kept in a few strings and arrays
+    instead of dictionaries of lists. Directories are numbered in
+    sorted order of their paths, so a parent's number is lower than
+    its children's and the directories below a directory (the paths
+    starting with its path and "/") are numbered consecutively -- not
+    necessarily right after it: "a/b c" sorts between "a/b" and
+    "a/b/x". Per directory its mtime, parent, number of music files in the subtree
+    and ranges in the tables of file names, children and playlists are
+    kept. Directories without music files in their subtree are kept
+    for the next rescan but not shown. Names of directories and files
+    are also kept as compared by the search (see search_key()), and for
+    each trigram of these the numbers of the names containing it
+    (directories first, then files numbered after them).
+    """
+
+    def __init__(self, scans=None, tables=None, ndirs=None):
+        if tables is not None:
+            (self.dirs, self.mtimes, self.parents, self.lengths,
+             self.names, self.first_name, self.kids, self.first_kid,
+             self.lists, self.first_list, self.dir_keys, self.name_keys,
+             self.grams, self.first_post, self.posts) = tables
+        else:
+            self.build(scans or {})
+        self.playlists = self.lists[:]
+        self.playlists.sort()
+        self.playlists.append(memo_file)
+        if ndirs is None:
+            ndirs = 0
+            for n in self.lengths:
+                if n:
+                    ndirs += 1
+        # number of directories shown
+        self.ndirs = ndirs
+
+    def build(self, scans):
+        """fill tables from dictionary dir : (mtime, subdirs, files, playlists)"""
+        paths = scans.keys()
+        paths.sort()
+        ids = {}
+        for i in xrange(len(paths)):
+            ids[paths[i]] = i
+        self.dirs       = StringTable(paths)
+        self.mtimes     = array.array('d')
+        self.parents    = array.array('i')
+        self.lengths    = array.array('I')
+        self.first_name = array.array('I', [0])
+        self.first_kid  = array.array('I', [0])
+        self.first_list = array.array('I', [0])
+        self.kids       = array.array('I')
+        names = []
+        lists = []
+        for i in xrange(len(paths)):
+            path = paths[i]
+            mtime, subdirs, files, plists = scans[path]
+            if mtime is None:
+                mtime = -1.0
+            self.mtimes.append(mtime)
+            self.parents.append(ids.get(path[:string.rfind(path, "/")], -1))
+            self.lengths.append(len(files))
+            names.extend(files)
+            self.first_name.append(len(names))
+            kids = [ids[path + "/" + sd] for sd in subdirs if ids.has_key(path + "/" + sd)]
+            kids.sort()
+            self.kids.extend(kids)
+            self.first_kid.append(len(self.kids))
+            lists.extend(plists)
+            self.first_list.append(len(lists))
+        self.names = StringTable(names)
+        self.lists = StringTable(lists)
+        dir_keys  = [search_key(path[string.rfind(path, "/")+1:]) for path in paths]
+        name_keys = [search_key(name) for name in names]
+        self.dir_keys  = StringTable(dir_keys)
+        self.name_keys = StringTable(name_keys)
+        # inverted trigram index, the posting lists are sorted
+        postings = {}
+        i = 0
+        for keys in (dir_keys, name_keys):
+            for key in keys:
+                for gram in trigrams(key):
+                    posts = postings.get(gram)
+                    if posts is None:
+                        posts = postings[gram] = array.array('I')
+                    posts.append(i)
+                i += 1
+        grams = postings.keys()
+        grams.sort()
+        self.grams      = StringTable(grams)
+        self.first_post = array.array('I', [0])
+        self.posts      = array.array('I')
+        for gram in grams:
+            self.posts.extend(postings[gram])
+            self.first_post.append(len(self.posts))
+        # children come after their parent: add up subtrees from the end
+        for i in xrange(len(paths) - 1, -1, -1):
+            if self.parents[i] >= 0:
+                self.lengths[self.parents[i]] += self.lengths[i]
+
+    def tables(self):
+        return (self.dirs, self.mtimes, self.parents, self.lengths,
+                self.names, self.first_name, self.kids, self.first_kid,
+                self.lists, self.first_list, self.dir_keys, self.name_keys,
+                self.grams, self.first_post, self.posts)
+
+    def id(self, dir):
+        """number of directory dir, -1 if unknown"""
+        i = bisect.bisect_left(self.dirs, dir)
+        if i < len(self.dirs) and self.dirs[i] == dir:
+            return i
+        return -1
+
+    def __contains__(self, dir):
+        """true if dir is shown (contains music files)"""
+        i = self.id(dir)
+        return i >= 0 and self.lengths[i] > 0
+
+    def length(self, dir):
+        """number of music files in subtree dir"""
+        i = self.id(dir)
+        if i < 0:
+            return 0
+        return self.lengths[i]
+
+    def files(self, dir):
+        """sorted music files in directory dir"""
+        i = self.id(dir)
+        if i < 0:
+            return []
+        return self.names[self.first_name[i]:self.first_name[i+1]]
+
+    def children(self, dir):
+        """sorted subdirectories of dir containing music files"""
+        i = self.id(dir)
+        if i < 0:
+            return []
+        return [self.dirs[k] for k in self.kids[self.first_kid[i]:self.first_kid[i+1]]
+                if self.lengths[k]]
+
+    def alldirs(self):
+        """sorted list of directories containing music files"""
+        dirs    = self.dirs[:]
+        lengths = self.lengths[:]
+        return [dirs[i] for i in xrange(len(dirs)) if lengths[i]]
+
+    def subtree(self, dir):
+        """numbers of dir and all directories below"""
+        # the directories below dir are those starting with dir + "/",
+        # and "0" is the character following "/"
+        lo = bisect.bisect_left(self.dirs, dir + "/")
+        hi = bisect.bisect_left(self.dirs, dir + "0", lo)
+        i = self.id(dir)
+        if i >= 0:
+            return [i] + range(lo, hi)
+        return range(lo, hi)
+
+    def getfiles(self, dir):
+        """all music files in subtree dir, sorted by directory"""
+        files = []
+        for i in self.subtree(dir):
+            d = self.dirs[i]
+            for file in self.names[self.first_name[i]:self.first_name[i+1]]:
+                files.append(d + "/" + file)
+        return files
+
+    def matching(self, pattern):
+        """
+        numbers of the directories and music files whose names contain
+        pattern (see search_key()): (dirs, files, at most dirs, at most
+        files). dirs and files are iterators finding the matches in index
+        order as they are asked for; the upper bounds are None if unknown.
+        """
+        ndirs = len(self.dirs)
+        found = self.candidates(pattern)
+        if found is None:
+            # too short for the trigram index, look at every name
+            dirs  = (i for i in self.dir_keys.find(pattern) if self.lengths[i])
+            return dirs, self.name_keys.find(pattern), None, None
+        k = bisect.bisect_left(found, ndirs)
+        if len(pattern) == 3:
+            # a trigram itself, no need to look at the names
+            dirs  = (i for i in found[:k] if self.lengths[i])
+            files = (i - ndirs for i in found[k:])
+        else:
+            dirs  = (i for i in found[:k] if self.lengths[i] and pattern in self.dir_keys[i])
+            files = (i - ndirs for i in found[k:] if pattern in self.name_keys[i - ndirs])
+        return dirs, files, k, len(found) - k
+
+    def dir_paths(self, dirs):
+        """paths of directories numbered dirs"""
+        return [self.dirs[i] for i in dirs]
+
+    def file_paths(self, files):
+        """paths of music files numbered files (in order)"""
+        paths = []
+        end = 0
+        for j in files:
+            if j >= end:
+                # another directory
+                i = bisect.bisect_right(self.first_name, j) - 1
+                dir = self.dirs[i] + "/"
+                end = self.first_name[i+1]
+            paths.append(dir + self.names[j])
+        return paths
+
+    def candidates(self, pattern):
+        """
+        sorted numbers of the names containing all trigrams of pattern
+        (see class doc), None if pattern is too short to have any
+        """
+        if len(pattern) < 3:
+            return None
+        lists = []
+        for gram in trigrams(pattern):
+            k = bisect.bisect_left(self.grams, gram)
+            if k == len(self.grams) or self.grams[k] != gram:
+                return []
+            lists.append((self.first_post[k+1] - self.first_post[k], self.first_post[k]))
+        # start with the shortest posting list
+        lists.sort()
+        count, start = lists[0]
+        found = self.posts[start:start+count]
+        for count, start in lists[1:]:
+            if not found:
+                break
+            if count > 16 * len(found):
+                # look up the few candidates in the long list
+                found = [i for i in found if self.posted(i, start, count)]
+            else:
+                posts = set(self.posts[start:start+count])
+                found = [i for i in found if i in posts]
+        return found
+
+    def posted(self, i, start, count):
+        """true if i is in the posting list of count numbers at start"""
+        k = bisect.bisect_left(self.posts, i, start, start + count)
+        return k < start + count and self.posts[k] == i
+
+    def scan(self, dir):
+        """dir as returned by scan_dir() when it was read, None if unknown"""
+        i = self.id(dir)
+        if i < 0:
+            return None
+        mtime = self.mtimes[i]
+        if mtime < 0:
+            mtime = None
+        kids = [self.dirs[k][len(dir)+1:] for k in self.kids[self.first_kid[i]:self.first_kid[i+1]]]
+        return (mtime, kids, self.names[self.first_name[i]:self.first_name[i+1]],
+                self.lists[self.first_list[i]:self.first_list[i+1]])
+
+class ReadWriteLock:
+    """
+    lock shared by any number of readers or held by a single writer;
+    a waiting writer goes first, so readers can not starve it (a reader
+    must not acquire the lock again while holding it)
+    """
+
+    def __init__(self):
+        self.cond    = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writers_waiting = 0
+
+    def acquire_read(self):
+        self.cond.acquire()
+        while self.writers_waiting:
+            self.cond.wait()
+        self.readers += 1
+        self.cond.release()
+
+    def release_read(self):
+        self.cond.acquire()
+        self.readers -= 1
+        if not self.readers:
+            self.cond.notifyAll()
+        self.cond.release()
+
+    def acquire_write(self):
+        # new readers are kept out while we wait for the current ones
+        self.cond.acquire()
+        self.writers_waiting += 1
+        while self.readers:
+            self.cond.wait()
+        self.writers_waiting -= 1
+
+    def release_write(self):
+        # let in the readers waiting for us
+        self.cond.notifyAll()
+        self.cond.release()
+
 # Subroutines
 
 def moo():
@@ -1425,9 +3068,11 @@ def usage():
     print >> sys.stderr, """
 usage:
     %s [-p number] [-s] [-j name] [-a host] [-n net] [-h]
-    [-m] [-d] [-c configdir] [-t template] [--port=number] [--server-only]
-    [--jukebox-dir=name] [--add-host=host] [--add-network=net] [--help]
-    [--manual] [--debug] [--config=dir] [--template=file]
+    [-m] [-d] [-c configdir] [-t template] [-w number] [--port=number]
+    [--server-only] [--jukebox-dir=name] [--add-host=host]
+    [--add-network=net] [--help] [--manual] [--debug] [--config=dir]
+    [--template=file] [--workers=number] [--status-ttl=seconds]
+    [--chunk-size=number] [--watch=seconds]
 
 options:
     -p number, --port=number     set the server's portnumber to number
@@ -1441,6 +3086,11 @@ options:
     -d, --debug                  include debug information in HTML page
     -c dir, --config=dir         use moosic configuration in directory dir
     -t file, --template=file     use alternate HTML template file
+    -w number, --workers=number  serve requests with number worker threads
+    --status-ttl=seconds         show moosicd status at most seconds old
+    --chunk-size=number          send at most number files per call to moosicd
+    --watch=seconds              keep index current, poll every seconds
+                                 (unless pyinotify is available)
 """ % progname
 
 
@@ -1453,12 +3103,30 @@ def format_name(s):
     return s
 
 
+def plain_text(html):
+    """message html as plain text (for api answers)"""
+    text = re.sub(r"<br>", " ", html)
+    text = re.sub(r"<[^>]*>", "", text)
+    for entity, char in (("&nbsp;", " "), ("&lt;", "<"), ("&gt;", ">"),
+                         ("&quot;", '"'), ("&amp;", "&")):
+        text = string.replace(text, entity, char)
+    return string.join(string.split(text))
+
+
+def search_key(st):
+    """st as compared by the sloppy search: lower case, no accents, no blanks"""
+    return string.replace(string.translate(st, xlat), " ", "")
+
+
+def trigrams(key):
+    """set of substrings of length 3 of key"""
+    return set([key[k:k+3] for k in xrange(len(key) - 2)])
+
+
 def match(st, pat):
     """somewhat fuzzy name matcher"""
-    st = string.translate(st, xlat)
-    st = string.replace(st, " ", "")
     pat= string.replace(pat, " ", "")
-    return string.find(st, pat) >= 0
+    return string.find(search_key(st), pat) >= 0
 
 
 def mixin(l1,l2):
@@ -1482,68 +3150,447 @@ def mixin(l1,l2):
     return result
 
 
-def recurse(dir, tree, playlists, parent):
-    """read directory tree and store entries in dictionary"""
-    # global tree, playlists
+def rpc_size(value):
+    """estimated size of value marshalled for an XML-RPC request"""
+    if isinstance(value, Binary):
+        return binary_size(value.data)
+    elif type(value) in (type([]), type(())):
+        size = rpc_overhead
+        for item in value:
+            size += rpc_size(item)
+        return size
+    else:
+        return 40 + len(str(value))
+
+
+def binary_size(data):
+    """size of data marshalled as XML-RPC base64 value"""
+    n = len(data)
+    return 34 + 4 * ((n + 2) / 3) + (n + 56) / 57
+
+
+def plan_queue_changes(old, new):
+    """
+    Plan moosicd calls turning queue old into new: common head and tail
+    are left alone, pure deletions are cut, pure insertions inserted and
+    a single moved track is cut and re-inserted. Returns the cheapest of
+    this plan and replacing the whole queue, as list of
+    (method, items, argument) tuples.
+    """
+    replace = [("replace", new, None)]
+    lo, ln = len(old), len(new)
+    p = 0
+    while p < lo and p < ln and old[p] == new[p]:
+        p += 1
+    s = 0
+    while s < lo - p and s < ln - p and old[lo-s-1] == new[ln-s-1]:
+        s += 1
+    o = old[p:lo-s]
+    n = new[p:ln-s]
+
+    # runs of [start, end) to cut and (position, items) to insert, both
+    # relative to o; calls are made from the back so positions stay valid
+    cuts = []
+    inserts = []
+    if len(o) > len(n) and is_subsequence(n, o):
+        cuts = missing_runs(n, o)
+    elif len(o) < len(n) and is_subsequence(o, n):
+        inserts = [(pos, n[start:end]) for pos, start, end in inserted_runs(o, n)]
+    elif len(o) == len(n) and o[1:] == n[:-1]:
+        # first track moved to the end
+        cuts = [(0, 1)]
+        inserts = [(len(o), n[-1:])]
+    elif len(o) == len(n) and o[:-1] == n[1:]:
+        # last track moved to the front
+        cuts = [(len(o) - 1, len(o))]
+        inserts = [(0, n[:1])]
+    elif o or n:
+        cuts = [(0, len(o))]
+        inserts = [(0, n)]
+
+    plan = []
+    calls = []
+    for pos, items in inserts:
+        calls.append((pos, 0, items))
+    for start, end in cuts:
+        calls.append((start, 1, (start, end)))
+    # back to front, at equal positions cut before inserting
+    calls.sort()
+    calls.reverse()
+    for pos, cut, what in calls:
+        if cut:
+            start, end = what
+            plan.append(("cut", None, [p + start, p + end]))
+        elif p + pos == 0:
+            plan.append(("prepend", what, None))
+        elif pos == len(o) and not s:
+            plan.append(("append", what, None))
+        else:
+            plan.append(("insert", what, p + pos))
+
+    if plan_cost(plan) < plan_cost(replace):
+        return plan
+    return replace
+
+
+def plan_cost(plan):
+    """estimated number of bytes sent by plan"""
+    cost = 0
+    for method, items, arg in plan:
+        cost += rpc_overhead
+        if items is not None:
+            for item in items:
+                cost += binary_size(item)
+        if arg is not None:
+            cost += 40
+    return cost
+
+
+def is_subsequence(short, long):
+    """true if all items of short appear in long in the same order"""
+    i = 0
+    for item in long:
+        if i < len(short) and item == short[i]:
+            i += 1
+    return i == len(short)
+
+
+def missing_runs(short, long):
+    """runs [start, end) of long not matched by subsequence short"""
+    runs = []
+    i = 0
+    for j in range(len(long)):
+        if i < len(short) and long[j] == short[i]:
+            i += 1
+        elif runs and runs[-1][1] == j:
+            runs[-1] = (runs[-1][0], j + 1)
+        else:
+            runs.append((j, j + 1))
+    return runs
+
+
+def inserted_runs(short, long):
+    """runs of long not matched by subsequence short: (position in short, start, end)"""
+    runs = []
+    for start, end in missing_runs(short, long):
+        # items of long before start are matched or inserted earlier
+        inserted = 0
+        for pos, s, e in runs:
+            inserted += e - s
+        runs.append((start - inserted, start, end))
+    return runs
+
+
+def change_queue(old, new, running):
+    """
+    turn moosicd's queue (believed to be old) into new, sending as few
+    bytes as possible. Calls changing parts of the queue are planned
+    against a fresh copy while the queue is halted, so positions stay
+    valid; running tells whether to start the queue again afterwards.
+    """
+    plan = plan_queue_changes(old, new)
+    if plan[0][0] != "replace":
+        proxy.halt_queue()
+        try:
+            # old may be outdated: tracks played or other clients
+            plan = plan_queue_changes(fetch_queue(), new)
+            send_plan(plan)
+        finally:
+            if running:
+                proxy.run_queue()
+    else:
+        send_plan(plan)
+    queue.replaced(new, len(plan))
+
+
+def send_plan(plan):
+    """make moosicd calls planned by plan_queue_changes()"""
+    for method, items, arg in plan:
+        args = []
+        if items is not None:
+            args.append([Binary(i) for i in items])
+        if arg is not None:
+            args.append(arg)
+        getattr(proxy, method)(*args)
+
+
+def add_files(files, running, top=False):
+    """
+    add files to bottom (or top) of moosicd's queue keeping their order,
+    at most chunk_size files per call. The queue is halted meanwhile.
+    Returns the number of files added.
+    """
+    chunks = []
+    for i in range(0, len(files), chunk_size):
+        chunks.append(files[i:i+chunk_size])
+    if top:
+        # the last chunk goes first, the others are put in front of it
+        chunks.reverse()
+    proxy.halt_queue()
+    try:
+        for chunk in chunks:
+            if top:
+                proxy.prepend([Binary(i) for i in chunk])
+            else:
+                proxy.append([Binary(i) for i in chunk])
+    finally:
+        if running:
+            proxy.run_queue()
+    if top:
+        queue.prepended(files, len(chunks))
+    else:
+        queue.appended(files, len(chunks))
+    return len(files)
+
+
+def json_dumps(value):
+    """compact JSON representation of value"""
     try:
-        entries = os.listdir(dir)
+        return json.dumps(value, separators=(',', ':'))
+    except UnicodeDecodeError:
+        # file names are not UTF-8 encoded
+        return json.dumps(value, separators=(',', ':'), encoding='latin-1')
+
+
+def fetch_queue(start=0, end=None):
+    """fetch slice [start:end] of moosicd's queue"""
+    if end is None:
+        items = proxy.list([start])
+    else:
+        items = proxy.list([start, end])
+    return [i.data for i in items]
+
+
+def fetch_history(count=0):
+    """fetch the count most recently played files (all if 0), latest first"""
+    if count:
+        history = proxy.history(count)
+    else:
+        history = proxy.history()
+    history.reverse()
+    return [str(entry[0]) for entry in history]
+
+
+def player_settled(status, old=None):
+    """
+    true if moosicd plays a track or it is not going to start one: queue
+    halted or empty. Given old, the status snapshot before our command,
+    the track must have been started since: another file, or the same
+    one again with a new history entry or a current_time short of the
+    time it would have played by now
+    """
+    if status["current"]:
+        if old is None or status["current"] != old["current"]:
+            return True
+        if status["history_head"] != old["history_head"]:
+            return True
+        played = play_seconds(old["current_time"])
+        if not old["is_paused"]:
+            # old may be a cached snapshot
+            played += int(status["stamp"] - old["stamp"])
+        return play_seconds(status["current_time"]) < played
+    return not status["is_queue_running"] or not status["queue_length"]
+
+
+def play_seconds(current_time):
+    """seconds in moosicd's current_time ("[hh:]mm:ss")"""
+    seconds = 0
+    for part in string.split(current_time, ":"):
+        seconds = 60 * seconds + int(part)
+    return seconds
+
+
+def recurse(dir, scans, cache=None, progress=None, changed=None):
+    """
+    read directory tree and store each directory's (mtime, subdirectories,
+    music files, playlists) in dictionary scans. Directories found
+    unchanged in cache (the library of the last scan) are not read
+    again; progress (a ScanProgress) counts directories read and taken
+    from cache. If the
+    changed directories are known (dictionary changed) the others are
+    taken from cache without even looking at their mtime.
+    Subdirectories are read by up to 'workers' threads in parallel.
+    """
+    lock    = threading.Lock()
+    pending = Queue.Queue()
+    pending.put(dir)
+    # directories queued but not yet merged
+    outstanding = [1]
+
+    def walk():
+        while True:
+            d = pending.get()
+            if d is None:
+                return
+            try:
+                scan, cached = scan_dir(d, cache, changed)
+            except:
+                scan = None
+            lock.acquire()
+            try:
+                if scan is not None:
+                    # omit dirs without sufficient permission
+                    scans[d] = scan
+                    if progress is not None:
+                        progress.add(scan, cached)
+                    for sd in scan[1]:
+                        pending.put(d + "/" + sd)
+                    outstanding[0] += len(scan[1])
+                outstanding[0] -= 1
+                if outstanding[0] == 0:
+                    # all done, stop the walkers
+                    for i in range(len(walkers)):
+                        pending.put(None)
+            finally:
+                lock.release()
+
+    walkers = []
+    for i in range(max(workers, 1)):
+        walker = threading.Thread(target=walk)
+        # do not hold up exit while a background scan walks the tree
+        walker.setDaemon(True)
+        walkers.append(walker)
+    for walker in walkers:
+        walker.start()
+    for walker in walkers:
+        walker.join()
+    return scans
+
+def rescan(changed=None, progress=None):
+    """
+    scan jukebox directory again (see recurse()), build a new library
+    and publish it at once, then dump it -- unless no directory was read
+    nor vanished, then the library is kept as it is. Returns the
+    ScanProgress.
+    """
+    global library, generation
+    # one scan at a time, each one builds on the result of the last
+    scan_lock.acquire()
+    try:
+        if progress is None:
+            progress = ScanProgress(len(library.dirs))
+        # scan without holding the index lock, other requests go on meanwhile;
+        # only directories changed since the last scan are read
+        scans = recurse(myroot, {}, library, progress, changed)
+        if not progress.read and len(scans) == len(library.dirs):
+            # all taken from the library: keep it, the search cache and the data file
+            progress.finished = time.time()
+            return progress
+        # anything changed renumbers the directories and names sorted
+        # after it, so the tables and the trigram index are built anew
+        nlibrary = Library(scans)
+        del scans
+        index_lock.acquire_write()
+        try:
+            library = nlibrary
+            generation += 1
+        finally:
+            index_lock.release_write()
+        progress.finished = time.time()
+        dump_data()
+        return progress
+    finally:
+        scan_lock.release()
+
+def stale_dirs():
+    """
+    compare the mtimes of the jukebox dir and its subdirectories with
+    the library: return dictionary of directories to read again (see
+    rescan()) -- the whole subtree of each subdirectory changed
+    """
+    def changed_since(dir):
+        i = library.id(dir)
+        try:
+            return i < 0 or library.mtimes[i] != os.stat(dir).st_mtime
+        except OSError:
+            return True
+
+    changed = {}
+    scan = library.scan(myroot)
+    if scan is None or changed_since(myroot):
+        changed[myroot] = 1
+    if scan is not None:
+        for sd in scan[1]:
+            dir = myroot + "/" + sd
+            if changed_since(dir):
+                for i in library.subtree(dir):
+                    changed[library.dirs[i]] = 1
+    return changed
+
+def scan_dir(dir, cache=None, changed=None):
+    """
+    read directory dir, return (mtime, subdirectories, music files,
+    playlists) and whether it was taken from cache -- which it is if dir's
+    mtime did not change since, or without looking if dir is not in
+    changed (unless that is None)
+    """
+    cached = None
+    if cache is not None:
+        cached = cache.scan(dir)
+    if changed is not None and cached and cached[0] is not None \
+            and not changed.has_key(dir):
+        return cached, True
+    try:
+        mtime = os.stat(dir).st_mtime
+        if cached and cached[0] == mtime:
+            return cached, True
+        if scandir is None:
+            entries = os.listdir(dir)
+        else:
+            entries = scandir(dir)
     except OSError:
-        # omit dirs without sufficient permission
-        return tree, playlists, parent
+        return None, False
     dirs=[]
     files=[]
-    for entry in entries:
-        # omit symlinks and hidden entries
-        pathname = dir+"/"+entry
-        if not os.path.islink(pathname) and entry[:1] != ".":
-            if os.path.isdir(pathname):
-                dirs.append(entry)
-            elif os.path.isfile(pathname):
-                if pathname.endswith(".m3u"):
-                    playlists.append(pathname)
-                elif file_is_moosical(pathname):
-                    files.append(entry)
+    lists=[]
+    if scandir is None:
+        for entry in entries:
+            # omit symlinks and hidden entries
+            pathname = dir+"/"+entry
+            if not os.path.islink(pathname) and entry[:1] != ".":
+                if os.path.isdir(pathname):
+                    dirs.append(entry)
+                elif os.path.isfile(pathname):
+                    if pathname.endswith(".m3u"):
+                        lists.append(pathname)
+                    elif file_is_moosical(pathname):
+                        files.append(entry)
+    else:
+        # file types are mostly known from the directory listing, no stat needed
+        for entry in entries:
+            # omit symlinks and hidden entries
+            if entry.name[:1] != "." and not entry.is_symlink():
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                elif entry.is_file():
+                    pathname = dir+"/"+entry.name
+                    if pathname.endswith(".m3u"):
+                        lists.append(pathname)
+                    elif file_is_moosical(pathname):
+                        files.append(entry.name)
     files.sort()
-    tree[dir]=files
-    for d in dirs:
-        parent[dir + "/" + d] = dir
-        tree, playlists, parent = recurse(dir + "/" + d, tree, playlists, parent)
-    return tree, playlists, parent
-
-def cleanup(tree, playlists):
-    ''' remove dirs containing no music files and invisible dirs from hash,
-        calculate total number of music files in subtrees.
-    '''
-    length={}
-    for dir in tree.keys():
-        l = 0
-        for sd in tree.keys():
-            if sd[:len(dir)] == dir:
-                l += len(tree[sd])
-        if l == 0 or string.find(dir,"/.") >= 0:
-            del tree[dir]
-        else:
-            length[dir]=l
-    # we rely on having at least an entry for the jukebox directory ...
-    if tree == {}:
-        tree = {myroot: []}
-        length[myroot] = 0
-
-    playlists.sort()
-    global memo_file
-    playlists.append(memo_file)
-    return tree, length, playlists
+    if time.time() - mtime < 2:
+        # dir may change again without its mtime changing, read it next time
+        mtime = None
+    return (mtime, dirs, files, lists), False
 
 def getfiles(dir):
-    """get all files in directory tree from dictionary"""
-    files = []
-    dirs = tree.keys()
-    dirs.sort()
-    for d in dirs:
-        if d[0:len(dir)] == dir:
-            for file in tree[d]:
-                files.append(d + "/" + file)
-    return files
+    """get all files in directory tree from library"""
+    index_lock.acquire_read()
+    try:
+        return library.getfiles(dir)
+    finally:
+        index_lock.release_read()
+
+
+def findfiles(pattern):
+    """get all music files matching search key pattern from library"""
+    index_lock.acquire_read()
+    try:
+        files = search_cache.get(pattern)[1]
+        return library.file_paths(files.get(files.count()))
+    finally:
+        index_lock.release_read()
 
 
 def file_is_moosical(filename):
@@ -1600,25 +3647,88 @@ def tuple2ip(tuple):
 
 
 def dump_data():
-    ''' dump data related to jukeboxdir to file in order to speed up next start'''
+    ''' write index of jukeboxdir to file in order to speed up next start'''
+    # header: format, jukebox dir, moosic config regexps and where to find
+    # each table of the library in the file (relative to the header's end)
+    entries = []
+    chunks  = []
+    offset  = 0
+    for table in library.tables():
+        if isinstance(table, StringTable):
+            parts = [table.offsets, table.content()]
+        else:
+            parts = [table]
+        entry = []
+        for part in parts:
+            if isinstance(part, str):
+                data = part
+                entry.append(("s", offset, len(data)))
+            else:
+                data = part.tostring()
+                entry.append((part.typecode, offset, len(part)))
+            # keep the numbers aligned
+            data += "\0" * (-len(data) % 8)
+            chunks.append(data)
+            offset += len(data)
+        entries.append(tuple(entry))
+    header = marshal.dumps({"version"  : index_version,
+                            "byteorder": sys.byteorder,
+                            "root"     : myroot,
+                            "regexps"  : [regexp.pattern for regexp in moosic_regexps],
+                            "ndirs"    : library.ndirs,
+                            "tables"   : tuple(entries)})
+    header += "\0" * (-(len(index_magic) + 4 + len(header)) % 8)
     try:
-        outfile = open(dump_fn, "wb")
-        marshal.dump((myroot, tree, parent, length, playlists), outfile)
+        # write a new file, the old one may still be mapped to memory
+        outfile = open(dump_fn + ".new", "wb")
+        outfile.write(index_magic)
+        outfile.write(struct.pack("<I", len(header)))
+        outfile.write(header)
+        for data in chunks:
+            outfile.write(data)
         outfile.close()
+        os.rename(dump_fn + ".new", dump_fn)
     except:
         print >> sys.stderr, "\n+++ can not create data file '%s'.\n" % dump_fn
 
 
 def load_dump():
-    ''' load data related to jukeboxdir from file in order to speed start-up '''
+    ''' map index of jukeboxdir from file to memory in order to speed start-up '''
     try:
         file = open(dump_fn, "rb")
-        (te, tr, pa, le, pl)  = marshal.load(file)
-        file.close()
-        return (te, tr, pa, le, pl)
+        try:
+            if file.read(len(index_magic)) != index_magic:
+                print "--- Data file was written by an older version"
+                return ("", None)
+            size = struct.unpack("<I", file.read(4))[0]
+            header = marshal.loads(file.read(size))
+            if header["version"] != index_version or header["byteorder"] != sys.byteorder:
+                print "--- Data file was written by another version"
+                return ("", None)
+            if header["regexps"] != [regexp.pattern for regexp in moosic_regexps]:
+                # music files are recognized differently now
+                print "--- Data file does not match moosic's configuration"
+                return ("", None)
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            file.close()
+        start = len(index_magic) + 4 + size
+        tables = []
+        for entry in header["tables"]:
+            parts = []
+            for typecode, offset, count in entry:
+                if typecode == "s":
+                    parts.append(start + offset)
+                else:
+                    parts.append(MappedArray(buffer, start + offset, typecode, count))
+            if len(parts) == 2:
+                tables.append(StringTable(data=buffer, offsets=parts[0], base=parts[1]))
+            else:
+                tables.append(parts[0])
+        return (header["root"], Library(tables=tuple(tables), ndirs=header["ndirs"]))
     except:
         print >> sys.stderr, "\n+++ can not read data file '%s'.\n" % dump_fn
-        return ("", {}, {}, {}, [])
+        return ("", None)
 
 
 
@@ -1636,6 +3746,10 @@ debug            = False       # you guessed it
 auto_inc         = True        # auto search for free port to connect to
 ignore_exit      = False       # ignore exit requests
 limit            = 250         # limit display to ... entries
+workers          = 4           # number of threads serving requests
+status_ttl       = 1.0         # max. age (seconds) of moosicd status shown
+chunk_size       = 500         # max. number of files sent per call to moosicd
+watch            = 0           # seconds between rescans by watcher, 0: off
 allowed_hosts = ['127.0.0.1']  # allow only these hosts
 allowed_networks = []
 
@@ -1648,10 +3762,10 @@ tfn              = os.path.join(mydir,"template.html")
 
 # scan command line options
 try:
-    optlist, args = getopt.getopt(sys.argv[1:], 'a:n:p:ij:shmdc:t:',
+    optlist, args = getopt.getopt(sys.argv[1:], 'a:n:p:ij:shmdc:t:w:',
                     ["add-host=", "add-network=", "port=", "ignore-exit", \
                     "jukebox-dir=", "server-only", "help", "manual", "debug", \
-                    "config=", "template="])
+                    "config=", "template=", "workers=", "status-ttl=", "chunk-size=", "watch="])
 except getopt.GetoptError:
     usage()
     sys.exit(2)
@@ -1706,6 +3820,30 @@ for i, j in optlist:
         configdir = j
     elif i in ('-t', '--template'):
         tfn = j
+    elif i in ('-w', '--workers'):
+        try:
+            workers = string.atoi(j)
+        except ValueError:
+            usage()
+            sys.exit(2)
+    elif i == '--status-ttl':
+        try:
+            status_ttl = string.atof(j)
+        except ValueError:
+            usage()
+            sys.exit(2)
+    elif i == '--chunk-size':
+        try:
+            chunk_size = max(string.atoi(j), 1)
+        except ValueError:
+            usage()
+            sys.exit(2)
+    elif i == '--watch':
+        try:
+            watch = max(string.atof(j), 1.0)
+        except ValueError:
+            usage()
+            sys.exit(2)
 
 if args:
     usage()
@@ -1735,6 +3873,38 @@ sto   = ' abcdefghijklmnopqrstuvwxyzszoyaaaaaaaceeeeiiiidnoooooouuuuyy' + \
         ' abcdefghijklmnopqrstuvwxyzsmzosaaaaaaaceeeeiiiidnoooooouuuuyyy'
 xlat  = string.maketrans(sfrom,sto)
 
+# commands changing moosicd's state, these are never executed concurrently
+mutating_commands = ("add_bottom", "add_top", "advance", "append", "batch", "clear2",
+                     "del_current", "deldup", "load_pl", "loop", "mixin",
+                     "move_bottom", "move_top", "pause", "play", "play_last",
+                     "play_next", "play_now", "prepend", "remove", "reverse",
+                     "shuffle", "skip", "sort", "stop", "tskip")
+command_lock = threading.RLock()
+
+# guards library against a concurrent rescan
+index_lock = ReadWriteLock()
+# counts the libraries published by rescans
+generation = 0
+# keeps rescans from overtaking each other
+scan_lock = threading.Lock()
+
+# time spent waiting for moosicd, per command
+latency = LatencyHistogram()
+
+# calls and bytes sent to moosicd, per command
+traffic = TrafficCounter()
+
+# search results referred to by batch commands
+search_results = SearchResults()
+
+# matches of the latest searches
+search_cache = SearchCache()
+
+# scans of the jukebox directory running in the background
+rescanner = Rescanner()
+
+rpc_overhead = 250      # estimated size of an XML-RPC request without arguments
+
 search_form = """
 <form method="get" action="%s">
 <table>
@@ -1765,6 +3935,22 @@ clear_form = """
 </form>
 """
 
+# music files in files and search view can be selected for batch commands
+batch_form = """
+<form method="get" action="batch">
+<input type="hidden" name="view" value="%s">
+<input type="hidden" name="path" value="%s">
+<input type="hidden" name="pattern" value="%s">
+"""
+
+batch_buttons = """
+<tr><td colspan="%d">selected files:
+    <input type="submit" name="action" value="play"%s>
+    <input type="submit" name="action" value="prepend">
+    <input type="submit" name="action" value="append">
+</td></tr>
+"""
+
 # read page template from a file (template shall be located in same dir as this file)
 try:
     template= open(tfn).read()
@@ -1773,7 +3959,7 @@ except IOError:
     sys.exit(1)
 
 #make connection to locally running moosicd
-proxy = moosic.client.factory.LocalMoosicProxy(configdir + "/socket")
+proxy = SerializedProxy(moosic.client.factory.LocalMoosicProxy(configdir + "/socket"))
 try:
     proxy.no_op()
 except socket.error, e:
@@ -1808,12 +3994,25 @@ if api[0] < 1 or (api[0]==1 and api[1] < 7):
     print >> sys.stderr, "\n*** Moosic api version %d.%d is not supported (must be 1.7 or later).\n" % (api[0], api[1])
     sys.exit(1)
 
+# keep a snapshot of moosicd's status in the background
+poller = StatusPoller(status_ttl)
+proxy.write_hooks.append(poller.invalidate)
+poller.start()
+
+# local copy of moosicd's queue
+queue = QueueMirror()
+proxy.write_hooks.append(queue.written)
+
+# clients following moosicd's status through /events
+events = EventStream()
+events.start()
+
 # start web server
 for i in range(65536 - port):
     print "--- Webserver is trying to connect to port %d ... " % port
     try:
         server_address = ('', port)
-        httpd = BaseHTTPServer.HTTPServer(server_address, moosicWebGUIHTTPRequestHandler)
+        httpd = moosicWebGUIHTTPServer(server_address, moosicWebGUIHTTPRequestHandler, workers)
     except socket.error, exc:
         # error code 98: Address already in use
         if exc.args[0] == 98 and auto_inc:
@@ -1852,26 +4051,34 @@ except OSError:
 
 # load dumped data from file
 dump_fn = os.path.join(configdir, ".moosicWebGUI-dump.dat")
+index_magic = "moosicWebGUI index\n"
+index_version = 5
 print "--- Loading data from file '%s'" % dump_fn
-temp, tree, parent, length, playlists = load_dump()
+temp, library = load_dump()
 if temp != myroot:
     print "--- Scanning jukebox directory '%s'" % myroot
-    # read jukebox directory and store result to a hash if jukeboxdir
-    # does not match the stored version.
-    # Read in Jukebox directory, get
-    # tree : dictionary with directory : [filenames] mapping
-    # playlists : list containing playlist filenames
-    # parent: dictionary with directory : parent_dir mapping
-    tree, playlists, parent = recurse(myroot, {}, [], {myroot : None})
-
-    # remove dirs containing no music files and invisible dirs from tree dirctionary, get
-    # tree : cleaned-up dictionary with directory : [filenames] mapping
-    # length : dir : total number of files in subtree
-    # playlists : playlists plus memo file
-    tree, length, playlists = cleanup(tree, playlists)
+    # read jukebox directory if jukeboxdir does not match the stored
+    # version, get a dictionary with
+    # directory : (mtime, subdirs, music files, playlists) mapping
+    # and build the library (see class Library) from it
+    library = Library(recurse(myroot, {}))
 
     # dump Jukebox data to file (for next start-up)
     dump_data()
+else:
+    # read the parts changed while we were down, meanwhile serve the old index
+    changed = stale_dirs()
+    if changed:
+        print "--- Updating index of %d directories in the background" % len(changed)
+        rescanner.start(changed)
+
+# keep index of jukebox directory current
+if watch:
+    if pyinotify is None:
+        print "--- Checking jukebox directory for changes every %g seconds" % watch
+    else:
+        print "--- Watching jukebox directory for changes"
+    IndexWatcher(watch).start()
 
 # launch web browser unless server-only mode
 url = "http://localhost:%s/" % port
@@ -1897,11 +4104,13 @@ while not end_flag or ignore_exit:
         httpd.server_close()
         try:
             print '--- Trying to start new server instance ...'
-            httpd = BaseHTTPServer.HTTPServer(server_address, moosicWebGUIHTTPRequestHandler)
+            httpd = moosicWebGUIHTTPServer(server_address, moosicWebGUIHTTPRequestHandler, workers)
         except:
             print >> sys.stderr, '\n*** Can not start new server, giving up. Sorry.\n'
             sys.exit(1)
 
+# let the workers finish pending requests (including the good-bye page)
+httpd.server_close()
 print '\n+++ Caught exit request. %s shut down.\n' % progname
 
 sys.exit(0)
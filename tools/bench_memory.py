@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: Latin-1 -*-
+#
+########################################################################
+#
+#   bench_memory -- memory taken by the index per million music files
+#
+#   usage: bench_memory.py [-f files] [music files ...]
+#
+#   For each number of music files (default: 100000 1000000) a jukebox
+#   of artist/album directories with 'files' music files per album
+#   (default: 20) is indexed. Reported per million music files: the
+#   growth of the resident set size when loading the index kept as
+#   dictionaries of lists (tree, parent and length by path, as up to
+#   version 0.9.1) and as tables (class Library), and the size of the
+#   tables: directories and names, search keys and trigram index.
+#   Both are loaded from a marshalled copy by a process of their own.
+#
+########################################################################
+
+
+import array, gc, getopt, marshal, os, subprocess, sys, tempfile
+
+import benchutil
+
+
+def loaded(kind, dump):
+    """bytes the resident set of a new process grows by loading dump"""
+    fd, path = tempfile.mkstemp()
+    try:
+        os.write(fd, dump)
+        os.close(fd)
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "-l", kind, path],
+                                 stdout=subprocess.PIPE)
+        return int(child.communicate()[0])
+    finally:
+        os.remove(path)
+
+
+def load(kind, path):
+    """child process: print bytes the resident set grew by loading path"""
+    ns = benchutil.load()
+    dump = open(path, "rb").read()
+    gc.collect()
+    before = benchutil.rss()
+    if kind == "dicts":
+        data = marshal.loads(dump)
+    else:
+        data = load_tables(ns, dump)
+    gc.collect()
+    # dump was there before as well
+    print benchutil.rss() - before
+
+
+def dicts(scans):
+    """the index as dictionaries of lists by path, marshalled"""
+    tree   = {}
+    parent = {}
+    for dir, (mtime, subdirs, files, lists) in scans.items():
+        tree[dir] = files
+        for sd in subdirs:
+            parent[dir + "/" + sd] = dir
+    length = {}
+    for dir in tree.keys():
+        length[dir] = length.get(dir, 0) + len(tree[dir])
+        p = parent.get(dir)
+        while p is not None:
+            length[p] = length.get(p, 0) + len(tree[dir])
+            p = parent.get(p)
+    return marshal.dumps((tree, parent, length))
+
+
+def tables(ns, library):
+    """the tables of library, marshalled"""
+    parts = []
+    for table in library.tables():
+        if isinstance(table, ns["StringTable"]):
+            parts.append(("s", table.content(), table.offsets.typecode, table.offsets.tostring()))
+        else:
+            parts.append(("a", table.typecode, table.tostring()))
+    return marshal.dumps(parts)
+
+
+def load_tables(ns, dump):
+    tables = []
+    for part in marshal.loads(dump):
+        if part[0] == "s":
+            offsets = array.array(part[2])
+            offsets.fromstring(part[3])
+            tables.append(ns["StringTable"](data=part[1], offsets=offsets))
+        else:
+            numbers = array.array(part[1])
+            numbers.fromstring(part[2])
+            tables.append(numbers)
+    return ns["Library"](tables=tuple(tables))
+
+
+def size(ns, table):
+    """bytes in table"""
+    if isinstance(table, ns["StringTable"]):
+        return len(table.content()) + table.offsets.itemsize * len(table.offsets)
+    return table.itemsize * len(table)
+
+
+def main():
+    files = 20
+    optlist, args = getopt.getopt(sys.argv[1:], "f:l:")
+    for opt, value in optlist:
+        if opt == "-f":
+            files = int(value)
+        elif opt == "-l":
+            load(value, args[0])
+            return
+    counts = [int(arg) for arg in args] or [100000, 1000000]
+
+    print "%10s %10s   %s" % ("files", "dirs", "MB per million music files")
+    for count in counts:
+        ns = benchutil.load()
+        scans = benchutil.scans("/music", count / files * 11 / 10 + 1, files)
+        nfiles = 0
+        for scan in scans.values():
+            nfiles += len(scan[2])
+        ndirs = len(scans)
+        old = dicts(scans)
+        library = ns["Library"](scans)
+        del scans
+        sizes = [size(ns, table) for table in library.tables()]
+        new = tables(ns, library)
+        del library
+        old_mb = float(loaded("dicts", old)) / nfiles
+        new_mb = float(loaded("tables", new)) / nfiles
+        names = sum(sizes[:10])
+        keys  = sum(sizes[10:12])
+        grams = sum(sizes[12:])
+        print "%10d %10d   dictionaries %.0f, tables %.0f (names %.0f, search keys %.0f, trigrams %.0f)" % \
+              (nfiles, ndirs, old_mb, new_mb, 1e6 * names / nfiles / 1e6,
+               1e6 * keys / nfiles / 1e6, 1e6 * grams / nfiles / 1e6)
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+# -*- coding: Latin-1 -*-
+#
+########################################################################
+#
+#   bench_scan -- time building the index against the number of
+#   directories in the jukebox
+#
+#   usage: bench_scan.py [-f files] [-d dir] [directories ...]
+#
+#   For each number of directories (default: 1000 10000 100000
+#   1000000) a jukebox of artist/album directories with 'files' music
+#   files per album (default: 2) is indexed: the time per directory
+#   stays about the same if building the index (including the sums of
+#   music files per subtree) is linear in the number of directories.
+#   With -d the jukebox is also created on disk below dir and read by
+#   recurse(), as a rescan would.
+#
+########################################################################
+
+
+import getopt, os, shutil, sys, time
+
+import benchutil
+
+
+def main():
+    files = 2
+    disk  = None
+    optlist, args = getopt.getopt(sys.argv[1:], "f:d:")
+    for opt, value in optlist:
+        if opt == "-f":
+            files = int(value)
+        elif opt == "-d":
+            disk = value
+    counts = [int(arg) for arg in args] or [1000, 10000, 100000, 1000000]
+
+    header = "%10s %10s %10s %10s" % ("dirs", "files", "index s", "us/dir")
+    if disk is not None:
+        header += " %10s %10s" % ("read s", "us/dir")
+    print header
+    for count in counts:
+        root = "/music"
+        if disk is not None:
+            root = os.path.join(os.path.abspath(disk), "jukebox-%d" % count)
+        ns = benchutil.load(root)
+        scans = benchutil.scans(root, count, files)
+        ndirs = len(scans)
+        nfiles = 0
+        for scan in scans.values():
+            nfiles += len(scan[2])
+        start = time.time()
+        ns["Library"](scans)
+        index = time.time() - start
+        del scans
+        line = "%10d %10d %10.2f %10.1f" % (ndirs, nfiles, index, 1e6 * index / ndirs)
+        if disk is not None:
+            benchutil.make_tree(root, count, files)
+            start = time.time()
+            ns["recurse"](root, {})
+            seconds = time.time() - start
+            line += " %10.2f %10.1f" % (seconds, 1e6 * seconds / ndirs)
+            shutil.rmtree(root)
+        print line
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# -*- coding: Latin-1 -*-
+#
+########################################################################
+#
+#   bench_search -- time searches normalizing every name per search
+#   against searches in the search keys kept in the index
+#
+#   usage: bench_search.py [-f files] [music files]
+#
+#   A jukebox of artist/album directories with 'files' music files per
+#   album (default: 20) and as many music files as given (default:
+#   1000000) is indexed. For a few patterns all matching directories
+#   and music files are looked for
+#   - as up to version 0.9.1: each name is normalized by match() (see
+#     search_key()) and compared in turn,
+#   - in the search keys of the index: one substring scan over the
+#     folded names (class StringTable),
+#   - using the trigram index (Library.matching()), for reference.
+#
+########################################################################
+
+
+import getopt, random, string, sys, time
+
+import benchutil
+
+
+def timed(search):
+    """(milliseconds, number of matches) of search()"""
+    start = time.time()
+    found = search()
+    return 1000 * (time.time() - start), found
+
+
+def main():
+    files = 20
+    optlist, args = getopt.getopt(sys.argv[1:], "f:")
+    for opt, value in optlist:
+        if opt == "-f":
+            files = int(value)
+    count = 1000000
+    if args:
+        count = int(args[0])
+
+    ns = benchutil.load()
+    scans = benchutil.scans("/music", count / files * 11 / 10 + 1, files)
+    library = ns["Library"](scans)
+    del scans
+    # the names as kept in memory up to version 0.9.1
+    tree = [(dir[dir.rfind("/")+1:], library.files(dir)) for dir in library.alldirs()]
+    match      = ns["match"]
+    search_key = ns["search_key"]
+    xlat       = ns["xlat"]
+
+    rnd = random.Random(2)
+    patterns = [benchutil.word(rnd), benchutil.word(rnd) + " " + benchutil.word(rnd),
+                benchutil.word(rnd)[:3], "01 - ", "zq", "no such name"]
+    print "%d music files in %d directories" % (len(library.names), library.ndirs)
+    print "%-24s %8s %12s %12s %12s" % ("pattern", "matches", "0.9.1 ms", "keys ms", "trigrams ms")
+    for pattern in patterns:
+        def old():
+            mpattern = string.translate(pattern, xlat)
+            found = 0
+            for dir, names in tree:
+                if match(dir, mpattern):
+                    found += 1
+                for name in names:
+                    if match(name, mpattern):
+                        found += 1
+            return found
+
+        def keys():
+            key = search_key(pattern)
+            found = 0
+            for i in library.dir_keys.find(key):
+                if library.lengths[i]:
+                    found += 1
+            for i in library.name_keys.find(key):
+                found += 1
+            return found
+
+        def trigrams():
+            dirs, names, ndirs, nnames = library.matching(search_key(pattern))
+            return len(list(dirs)) + len(list(names))
+
+        old_ms, old_found = timed(old)
+        keys_ms, keys_found = timed(keys)
+        grams_ms, grams_found = timed(trigrams)
+        assert old_found == keys_found == grams_found
+        print "%-24r %8d %12.1f %12.1f %12.1f" % (pattern, keys_found, old_ms, keys_ms, grams_ms)
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
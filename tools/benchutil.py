@@ -0,0 +1,96 @@
+# -*- coding: Latin-1 -*-
+#
+########################################################################
+#
+#   benchutil -- helpers shared by the benchmark scripts
+#
+#   The classes and functions of moosicWebGUI.py are taken from the
+#   script itself (everything before its main program), so module
+#   moosic has to be installed as for moosicWebGUI.py.
+#
+########################################################################
+
+
+import os, re, random, resource, sys
+
+source_fn = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         os.pardir, "moosicWebGUI.py")
+
+words = None
+
+
+def load(root="/music"):
+    """namespace with the definitions of moosicWebGUI.py for jukebox dir root"""
+    source = open(source_fn).read()
+    main = source.index("# MAIN PROGRAM")
+    ns = {"__name__": "moosicWebGUI"}
+    exec source[:main] in ns
+    # the translation table of the sloppy search
+    exec re.search(r"^sfrom.*?^xlat[^\n]*\n", source[main:], re.M | re.S).group(0) in ns
+    ns["myroot"]         = root
+    ns["workers"]        = 4
+    ns["memo_file"]      = os.path.join(root, ".memo.m3u")
+    ns["moosic_regexps"] = [re.compile(r"\.(mp3|ogg|flac)$", re.I)]
+    return ns
+
+
+def word(rnd):
+    global words
+    if words is None:
+        r = random.Random(0)
+        words = ["".join([r.choice("abcdefghijklmnopqrstuvwxyz") for i in range(r.randint(3, 9))])
+                 for w in range(20000)]
+    return rnd.choice(words).capitalize()
+
+
+def layout(ndirs, files=2, seed=1):
+    """
+    directories of a jukebox of about ndirs directories, artist/album
+    with 10 albums per artist and files music files per album: yields
+    (relative path, subdirectories, music files), parents first
+    """
+    rnd = random.Random(seed)
+    artists = max((ndirs - 1) / 11, 1)
+    names = ["%s %s %05d" % (word(rnd), word(rnd), a) for a in range(artists)]
+    yield "", names, []
+    for artist in names:
+        albums = ["%d - %s %s" % (1990 + b, word(rnd), word(rnd)) for b in range(10)]
+        yield artist, albums, []
+        for album in albums:
+            tracks = ["%02d - %s %s %s.mp3" % (t + 1, word(rnd), word(rnd), word(rnd))
+                      for t in range(files)]
+            yield artist + "/" + album, [], tracks
+
+
+def scans(root, ndirs, files=2):
+    """dictionary as filled by recurse() for layout(ndirs, files) below root"""
+    result = {}
+    for path, dirs, tracks in layout(ndirs, files):
+        if path:
+            path = root + "/" + path
+        else:
+            path = root
+        result[path] = (1.0e9, dirs, tracks, [])
+    return result
+
+
+def make_tree(root, ndirs, files=2):
+    """create layout(ndirs, files) below root on disk, empty music files"""
+    for path, dirs, tracks in layout(ndirs, files):
+        dir = os.path.join(root, path)
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        for track in tracks:
+            open(os.path.join(dir, track), "w").close()
+
+
+def rss():
+    """resident set size of this process in bytes"""
+    try:
+        return int(open("/proc/self/statm").read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # no /proc: the peak, in kB on Linux and bytes on BSD
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform.startswith("linux"):
+            usage *= 1024
+        return usage